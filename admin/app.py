@@ -1,28 +1,42 @@
 # admin/app.py
 
+import csv
+import io
+import json
 import os
 from datetime import datetime, timedelta
-from typing import List
+from typing import Any, AsyncIterator, Callable, List, Optional
+from urllib.parse import urlencode
 
 from fastapi import (
     FastAPI,
     Request,
     Depends,
     Form,
+    Query,
     HTTPException,
     status,
     Response,
 )
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-from sqlalchemy import select, update
+from sqlalchemy import exists, false, func, literal_column, or_, select, true, update
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import aliased, sessionmaker
 
 # Импорт модели User из core/database.py
-from core.database import User
+from core.database import (
+    AdminJob,
+    Payment,
+    User,
+    enqueue_wg_task,
+    get_admin_job_progress,
+    notify_expiration_change,
+    notify_user_change,
+    run_bulk_action,
+)
 
 # Переменные окружения
 DATABASE_URL = os.getenv(
@@ -30,6 +44,11 @@ DATABASE_URL = os.getenv(
     "postgresql+asyncpg://postgres:postgres@db:5432/users_db"
 )
 ADMIN_SECRET = os.getenv("ADMIN_SECRET", "changeme")
+# Пользователей на одной странице списка
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "50"))
+# Выгрузка: строк на одну короткую транзакцию и строк в одной порции курсора
+EXPORT_WINDOW = int(os.getenv("EXPORT_WINDOW", "20000"))
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "1000"))
 
 # Настраиваем асинхронный движок и сессии SQLAlchemy
 engine = create_async_engine(DATABASE_URL, echo=False, future=True)
@@ -113,13 +132,76 @@ async def index():
     return RedirectResponse(url="/users")
 
 
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _user_filters(status_filter: str, trial: str, expiring_days: str, q: str) -> list:
+    """
+    Условия WHERE для фильтров списка пользователей. Каждое опирается на индекс:
+    статус и срок — ix_users_status_expiration, пробный — ix_users_trial_used_id,
+    поиск — триграммные индексы ix_users_telegram_id_trgm / ix_users_username_trgm.
+    """
+    conditions = []
+    if status_filter == "none":
+        conditions.append(User.config_status.is_(None))
+    elif status_filter:
+        conditions.append(User.config_status == status_filter)
+
+    # = true / = false, а не IS — иначе условие не использует индекс
+    if trial == "yes":
+        conditions.append(User.trial_used == true())
+    elif trial == "no":
+        conditions.append(or_(User.trial_used == false(), User.trial_used.is_(None)))
+
+    if expiring_days.strip().isdigit():
+        now = datetime.utcnow()
+        if not status_filter:
+            # Истекает — значит, ещё активен; явно выбранный статус не переопределяем
+            conditions.append(User.config_status == "active")
+        conditions += [
+            User.expiration_time >= now,
+            User.expiration_time <= now + timedelta(days=int(expiring_days)),
+        ]
+
+    q = q.strip().lstrip("@")
+    if q:
+        pattern = f"%{_escape_like(q)}%"
+        conditions.append(or_(User.telegram_id.like(pattern), User.username.ilike(pattern)))
+    return conditions
+
+
 @app.get("/users", response_class=HTMLResponse, dependencies=[Depends(check_admin)])
-async def list_users(request: Request, session: AsyncSession = Depends(get_session)):
+async def list_users(
+    request: Request,
+    status_filter: str = Query("", alias="status"),
+    trial: str = "",
+    expiring_days: str = "",
+    q: str = "",
+    after: Optional[int] = None,
+    before: Optional[int] = None,
+    session: AsyncSession = Depends(get_session),
+):
     """
-    Отображает таблицу всех пользователей.
+    Таблица пользователей по страницам ADMIN_PAGE_SIZE строк.
+    Пагинация по ключу (id > after / id < before) — страница читается за
+    одинаковое время, сколько бы пользователей ни было в таблице.
     """
-    result = await session.execute(select(User).order_by(User.id))
+    query = select(User).where(*_user_filters(status_filter, trial, expiring_days, q))
+    if before is not None:
+        query = query.where(User.id < before).order_by(User.id.desc())
+    else:
+        if after is not None:
+            query = query.where(User.id > after)
+        query = query.order_by(User.id)
+
+    # Лишняя строка показывает, есть ли следующая страница
+    result = await session.execute(query.limit(ADMIN_PAGE_SIZE + 1))
     users: List[User] = result.scalars().all()
+    has_more = len(users) > ADMIN_PAGE_SIZE
+    users = users[:ADMIN_PAGE_SIZE]
+    if before is not None:
+        users.reverse()
 
     user_list = []
     for u in users:
@@ -141,23 +223,48 @@ async def list_users(request: Request, session: AsyncSession = Depends(get_sessi
             "notified": "Да" if u.notified else "Нет",
         })
 
+    filters = {"status": status_filter, "trial": trial, "expiring_days": expiring_days, "q": q}
+    active_filters = {key: value for key, value in filters.items() if value}
+    prev_url = next_url = None
+    if users:
+        # Назад — если пришли со следующей страницы или есть строки до первой
+        if after is not None or (before is not None and has_more):
+            prev_url = "/users?" + urlencode({**active_filters, "before": users[0].id})
+        if has_more or before is not None:
+            next_url = "/users?" + urlencode({**active_filters, "after": users[-1].id})
+
     return templates.TemplateResponse(
         "users.html",
-        {"request": request, "users": user_list}
+        {
+            "request": request,
+            "users": user_list,
+            "filters": filters,
+            "prev_url": prev_url,
+            "next_url": next_url,
+        }
     )
 
 
 @app.post("/users/{telegram_id}/disable", dependencies=[Depends(check_admin)])
 async def disable_user(telegram_id: str, session: AsyncSession = Depends(get_session)):
     """
-    Отключение платного конфига пользователя:
-    config_status='disabled', сброс config_id и expiration_time.
+    Отключение платного конфига пользователя: config_status='disabled',
+    сброс expiration_time. config_id сохраняется — клиент отключается на
+    сервере WireGuard задачей wg_tasks, поставленной в той же транзакции,
+    и снова включается при следующей оплате или включении из админки.
     """
-    await session.execute(
+    result = await session.execute(
         update(User)
         .where(User.telegram_id == telegram_id)
-        .values(config_status="disabled", expiration_time=None, config_id=None)
+        # notified=True: отключение вручную — уведомление об истечении срока не нужно
+        .values(config_status="disabled", expiration_time=None, notified=True)
+        .returning(User.server_id, User.config_id)
     )
+    row = result.first()
+    if row is not None and row.config_id:
+        await enqueue_wg_task(session, telegram_id, row.server_id, row.config_id, "disable")
+    # Бот сбросит закэшированную строку пользователя после commit
+    await notify_user_change(session, telegram_id)
     await session.commit()
     return RedirectResponse(url="/users", status_code=status.HTTP_302_FOUND)
 
@@ -170,13 +277,290 @@ async def enable_user(
 ):
     """
     Включение платного конфига на указанное количество days дней:
-    config_status='active', expiration_time=now+days.
+    config_status='active', expiration_time=now+days. Если у пользователя
+    есть клиент WireGuard, он включается задачей wg_tasks из той же транзакции.
     """
     new_exp = datetime.utcnow() + timedelta(days=days)
-    await session.execute(
+    result = await session.execute(
         update(User)
         .where(User.telegram_id == telegram_id)
-        .values(config_status="active", expiration_time=new_exp)
+        .values(config_status="active", expiration_time=new_exp, reminded_hours=None)
+        .returning(User.server_id, User.config_id)
     )
+    row = result.first()
+    if row is not None and row.config_id:
+        await enqueue_wg_task(session, telegram_id, row.server_id, row.config_id, "enable")
+    # Планировщик отключений в боте узнает о новом сроке после commit
+    await notify_expiration_change(session, new_exp)
+    await notify_user_change(session, telegram_id)
     await session.commit()
     return RedirectResponse(url="/users", status_code=status.HTTP_302_FOUND)
+
+
+_BULK_ACTIONS = {"extend": "Продление", "enable": "Включение", "disable": "Отключение"}
+
+
+@app.post("/users/bulk", dependencies=[Depends(check_admin)])
+async def bulk_action(
+    action: str = Form(...),
+    days: int = Form(0),
+    status_filter: str = Form("", alias="status"),
+    trial: str = Form(""),
+    expiring_days: str = Form(""),
+    q: str = Form(""),
+    ids: str = Form(""),
+    all_users: bool = Form(False),
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Массовое действие над всеми пользователями, подходящими под фильтр списка
+    и (если задан) список Telegram ID. Изменение users выполняется одним
+    UPDATE, вызовы API WireGuard ставятся в очередь wg_tasks в той же
+    транзакции и выполняются ботом в фоне — прогресс на странице /jobs/{id}.
+    """
+    if action not in _BULK_ACTIONS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Неизвестное действие")
+    if action != "disable" and days < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Укажите число дней")
+
+    conditions = _user_filters(status_filter, trial, expiring_days, q)
+    id_list = [tg_id.lstrip("@") for tg_id in ids.replace(",", " ").split()]
+    if id_list:
+        conditions.append(User.telegram_id.in_(id_list))
+    if not conditions and not all_users:
+        # Без фильтра действие затронет всех — только с явным подтверждением
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Задайте фильтр или список ID, либо отметьте «всем пользователям»",
+        )
+
+    params = json.dumps(
+        {
+            "days": days,
+            "status": status_filter,
+            "trial": trial,
+            "expiring_days": expiring_days,
+            "q": q,
+            "ids": id_list,
+        },
+        ensure_ascii=False,
+    )
+    job_id = await run_bulk_action(session, action, conditions, days=days, params=params)
+    await session.commit()
+    return RedirectResponse(url=f"/jobs/{job_id}", status_code=status.HTTP_302_FOUND)
+
+
+async def _job_progress(job_id: int, session: AsyncSession) -> dict:
+    job = await session.get(AdminJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Задание не найдено")
+    progress = await get_admin_job_progress(session, job_id)
+    return {
+        "id": job.id,
+        "action": job.action,
+        "params": json.loads(job.params or "{}"),
+        "affected": job.affected,
+        "created_at": job.created_at.isoformat(sep=" ", timespec="seconds"),
+        **progress,
+        "finished": progress["pending"] == 0,
+    }
+
+
+@app.get("/jobs/{job_id}.json", dependencies=[Depends(check_admin)])
+async def job_progress_json(job_id: int, session: AsyncSession = Depends(get_session)):
+    return await _job_progress(job_id, session)
+
+
+@app.get("/jobs/{job_id}", response_class=HTMLResponse, dependencies=[Depends(check_admin)])
+async def job_progress_page(
+    request: Request,
+    job_id: int,
+    session: AsyncSession = Depends(get_session),
+):
+    job = await _job_progress(job_id, session)
+    return templates.TemplateResponse(
+        "job.html",
+        {"request": request, "job": job, "action_title": _BULK_ACTIONS.get(job["action"], job["action"])},
+    )
+
+
+@app.get("/stats", response_class=HTMLResponse, dependencies=[Depends(check_admin)])
+async def payment_stats(
+    request: Request,
+    days: int = 30,
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Выручка и продления по дням за последние days дней.
+    Продление — платёж пользователя, у которого уже были платежи раньше
+    (проверяется по индексу ix_payments_telegram_id_created_at).
+    """
+    since = datetime.utcnow() - timedelta(days=days)
+    earlier = aliased(Payment)
+    is_renewal = exists().where(
+        earlier.telegram_id == Payment.telegram_id,
+        earlier.created_at < Payment.created_at,
+    )
+    # 'day' — литералом: с параметром Postgres не сочтёт выражения в SELECT и GROUP BY одинаковыми
+    day = func.date_trunc(literal_column("'day'"), Payment.created_at).label("day")
+
+    result = await session.execute(
+        select(
+            day,
+            func.count().label("payments"),
+            func.sum(Payment.amount).label("amount"),
+            func.count().filter(is_renewal).label("renewals"),
+            func.count(Payment.telegram_id.distinct()).label("payers"),
+        )
+        .where(Payment.created_at >= since)
+        .group_by(day)
+        .order_by(day.desc())
+    )
+
+    rows = []
+    for r in result:
+        rows.append({
+            "day": r.day.strftime("%Y-%m-%d"),
+            "payments": r.payments,
+            # Суммы в журнале в копейках
+            "amount": r.amount / 100,
+            "renewals": r.renewals,
+            "payers": r.payers,
+        })
+
+    totals = {
+        "payments": sum(r["payments"] for r in rows),
+        "amount": sum(r["amount"] for r in rows),
+        "renewals": sum(r["renewals"] for r in rows),
+    }
+
+    return templates.TemplateResponse(
+        "stats.html",
+        {"request": request, "rows": rows, "totals": totals, "days": days}
+    )
+
+
+_EXPORT_MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+_USER_EXPORT_COLUMNS = [
+    User.id,
+    User.telegram_id,
+    User.username,
+    User.trial_used,
+    User.trial_status,
+    User.trial_expiration_time,
+    User.config_id,
+    User.config_status,
+    User.expiration_time,
+    User.server_id,
+]
+
+_PAYMENT_EXPORT_COLUMNS = [
+    Payment.id,
+    Payment.charge_id,
+    Payment.telegram_id,
+    Payment.option_key,
+    Payment.amount,
+    Payment.currency,
+    Payment.hours,
+    Payment.created_at,
+]
+
+
+def _export_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+def _encode_rows(rows: list, names: List[str], fmt: str) -> bytes:
+    if fmt == "ndjson":
+        return "".join(
+            json.dumps(dict(zip(names, map(_export_value, row))), ensure_ascii=False) + "\n"
+            for row in rows
+        ).encode("utf-8")
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([list(map(_export_value, row)) for row in rows])
+    return buffer.getvalue().encode("utf-8")
+
+
+async def _stream_export(
+    columns: list,
+    conditions: list,
+    fmt: str,
+) -> AsyncIterator[bytes]:
+    """
+    Отдаёт строки порциями прямо из серверного курсора (stream + yield_per) —
+    в памяти не больше EXPORT_BATCH строк. Таблица читается окнами по
+    EXPORT_WINDOW строк по ключу id, каждое окно — в своей короткой
+    транзакции, поэтому выгрузка не держит одну транзакцию (и снимок) открытой.
+    """
+    id_column = columns[0]
+    names = [column.key for column in columns]
+    if fmt == "csv":
+        yield _encode_rows([names], names, "csv")
+
+    last_id = 0
+    while True:
+        query = (
+            select(*columns)
+            .where(id_column > last_id, *conditions)
+            .order_by(id_column)
+            .limit(EXPORT_WINDOW)
+            .execution_options(yield_per=EXPORT_BATCH)
+        )
+        count = 0
+        async with engine.connect() as conn:
+            result = await conn.stream(query)
+            async for rows in result.partitions():
+                count += len(rows)
+                last_id = rows[-1][0]
+                yield _encode_rows(rows, names, fmt)
+        if count < EXPORT_WINDOW:
+            return
+
+
+def _export_response(
+    stream: Callable[[], AsyncIterator[bytes]],
+    name: str,
+    fmt: str,
+) -> StreamingResponse:
+    if fmt not in _EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    filename = f"{name}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    return StreamingResponse(
+        stream(),
+        media_type=_EXPORT_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/export/users.{fmt}", dependencies=[Depends(check_admin)])
+async def export_users(
+    fmt: str,
+    status_filter: str = Query("", alias="status"),
+    trial: str = "",
+    expiring_days: str = "",
+    q: str = "",
+):
+    """
+    Выгрузка пользователей (с теми же фильтрами, что и /users) в CSV или NDJSON.
+    """
+    conditions = _user_filters(status_filter, trial, expiring_days, q)
+    return _export_response(
+        lambda: _stream_export(_USER_EXPORT_COLUMNS, conditions, fmt), "users", fmt
+    )
+
+
+@app.get("/export/payments.{fmt}", dependencies=[Depends(check_admin)])
+async def export_payments(fmt: str, days: Optional[int] = None):
+    """
+    Выгрузка журнала платежей (за последние days дней или целиком) в CSV или NDJSON.
+    Суммы — в копейках, как в таблице payments.
+    """
+    conditions = []
+    if days is not None:
+        conditions.append(Payment.created_at >= datetime.utcnow() - timedelta(days=days))
+    return _export_response(
+        lambda: _stream_export(_PAYMENT_EXPORT_COLUMNS, conditions, fmt), "payments", fmt
+    )
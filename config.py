@@ -30,3 +30,130 @@ DATABASE_URL = os.getenv(
     "DATABASE_URL",
     "postgresql+asyncpg://postgres:postgres@db:5432/users_db"
 )
+
+# Базовый URL API wg-easy, через который бот управляет клиентами WireGuard
+WG_API_URL = os.getenv("WG_API_URL", "http://109.71.246.92:51821/api")
+
+# Пароль от веб-интерфейса wg-easy
+WG_API_PASSWORD = os.getenv("WG_API_PASSWORD", "1234")
+
+# Сколько клиентов размещать на одном сервере WireGuard (подсеть wg-easy — /24).
+# WG_API_URL/WG_API_PASSWORD/WG_SERVER_CAPACITY задают сервер «default» в таблице
+# servers (адрес и пароль обновляются при каждом старте, ёмкость — только при
+# создании строки); остальные серверы добавляются строками в эту таблицу
+WG_SERVER_CAPACITY = int(os.getenv("WG_SERVER_CAPACITY", "250"))
+
+# Таймаут одного запроса к API WireGuard (в секундах)
+WG_API_TIMEOUT = float(os.getenv("WG_API_TIMEOUT", "10"))
+
+# Устойчивость запросов к API WireGuard (для каждого сервера отдельно):
+# таймаут установки соединения; число повторов идемпотентных запросов и базовая
+# пауза перед повтором (экспоненциальная, со случайным разбросом); доля повторов
+# от общего числа запросов, сверх которой повторы не делаются
+WG_API_CONNECT_TIMEOUT = float(os.getenv("WG_API_CONNECT_TIMEOUT", "3"))
+WG_API_RETRIES = int(os.getenv("WG_API_RETRIES", "2"))
+WG_API_RETRY_BASE_SECONDS = float(os.getenv("WG_API_RETRY_BASE_SECONDS", "0.2"))
+WG_API_RETRY_BUDGET = float(os.getenv("WG_API_RETRY_BUDGET", "0.2"))
+# Автоматический выключатель: после стольких ошибок подряд запросы к серверу
+# сразу отклоняются на WG_API_BREAKER_RESET_SECONDS секунд
+WG_API_BREAKER_THRESHOLD = int(os.getenv("WG_API_BREAKER_THRESHOLD", "5"))
+WG_API_BREAKER_RESET_SECONDS = float(os.getenv("WG_API_BREAKER_RESET_SECONDS", "30"))
+# Не больше стольких одновременных запросов к одному серверу (и keep-alive
+# соединений с ним); запрос, не дождавшийся очереди за WG_API_QUEUE_TIMEOUT
+# секунд, отклоняется. Единственная настройка параллелизма API WireGuard:
+# фоновым задачам достаётся половина (WG_API_CONCURRENCY ниже)
+WG_API_MAX_CONCURRENCY = int(os.getenv("WG_API_MAX_CONCURRENCY", "20"))
+WG_API_QUEUE_TIMEOUT = float(os.getenv("WG_API_QUEUE_TIMEOUT", "2"))
+# Одновременных запросов фоновых задач (отключение по сроку, тёплый пул,
+# сверка, wg_tasks) — вторая половина остаётся запросам пользователей
+WG_API_CONCURRENCY = max(1, WG_API_MAX_CONCURRENCY // 2)
+
+# Интервал полной пересинхронизации планировщика отключений с БД (в секундах)
+EXPIRY_RESYNC_SECONDS = int(os.getenv("EXPIRY_RESYNC_SECONDS", "600"))
+
+# Сколько .conf-файлов (и их file_id в Telegram) держать в памяти
+CONFIG_CACHE_SIZE = int(os.getenv("CONFIG_CACHE_SIZE", "10000"))
+
+# Пул соединений с БД: каждый апдейт держит одно соединение на всё время обработки.
+# Значения — на всю реплику бота: в режиме webhook они делятся между
+# WEBHOOK_WORKERS процессами (см. core/database.py). Сверх пула каждый процесс
+# держит 2–5 отдельных соединений (LISTEN, лидер); вместе с админкой всё это
+# должно помещаться в max_connections Postgres (по умолчанию 100)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+
+# Кэш строк пользователей в памяти бота: время жизни (в секундах) и максимум записей
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+# Режим получения апдейтов: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Настройки режима webhook: публичный URL (https://...), путь, секрет,
+# адрес/порт, на котором слушает бот, и число процессов-обработчиков.
+# WEBHOOK_URL и WEBHOOK_SECRET обязательны (секрет — 1–256 символов A-Z, a-z, 0-9, _ и -):
+# без секрета бот в режиме webhook не запускается
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+
+# Выбор лидера среди реплик бота: ключ advisory-блокировки Postgres,
+# период попыток захвата и проверки соединения лидера (в секундах)
+LEADER_LOCK_KEY = int(os.getenv("LEADER_LOCK_KEY", "482079"))
+LEADER_RETRY_SECONDS = float(os.getenv("LEADER_RETRY_SECONDS", "3"))
+
+# Отключение истёкших конфигов: число параллельных обработчиков и размер
+# захватываемой пачки
+EXPIRY_WORKERS = int(os.getenv("EXPIRY_WORKERS", "4"))
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", "50"))
+
+# Темп рассылки уведомлений: сообщений в секунду на процесс и минимальный
+# интервал между сообщениями в один чат (в секундах)
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "30"))
+NOTIFY_PER_CHAT_INTERVAL = float(os.getenv("NOTIFY_PER_CHAT_INTERVAL", "1"))
+
+# Как часто повторять недоставленные уведомления об отключении (в секундах)
+NOTIFY_RETRY_SECONDS = int(os.getenv("NOTIFY_RETRY_SECONDS", "30"))
+
+# Напоминания об окончании подписки: за сколько часов до expiration_time
+# их отправлять (через запятую) и как часто проверять (в секундах)
+REMINDER_OFFSETS_HOURS = sorted(
+    int(h) for h in os.getenv("REMINDER_OFFSETS_HOURS", "72,24").split(",") if h.strip()
+)
+REMINDER_INTERVAL_SECONDS = int(os.getenv("REMINDER_INTERVAL_SECONDS", "300"))
+
+# Выдача конфигов после оплаты: число обработчиков очереди заданий в каждом
+# процессе, период опроса очереди, время, на которое задание закрепляется
+# за обработчиком, пауза перед первым повтором и максимум попыток
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", "2"))
+PROVISION_POLL_SECONDS = float(os.getenv("PROVISION_POLL_SECONDS", "5"))
+PROVISION_LEASE_SECONDS = int(os.getenv("PROVISION_LEASE_SECONDS", "300"))
+PROVISION_RETRY_SECONDS = int(os.getenv("PROVISION_RETRY_SECONDS", "10"))
+PROVISION_MAX_ATTEMPTS = int(os.getenv("PROVISION_MAX_ATTEMPTS", "10"))
+
+# Тёплый пул заранее созданных клиентов WireGuard: размер не меньше MIN и не
+# больше MAX, иначе — спрос за WARM_POOL_WINDOW_SECONDS, пересчитанный на
+# WARM_POOL_HEADROOM_SECONDS вперёд; как часто пополнять пул (в секундах)
+WARM_POOL_MIN = int(os.getenv("WARM_POOL_MIN", "5"))
+WARM_POOL_MAX = int(os.getenv("WARM_POOL_MAX", "200"))
+WARM_POOL_WINDOW_SECONDS = int(os.getenv("WARM_POOL_WINDOW_SECONDS", "3600"))
+WARM_POOL_HEADROOM_SECONDS = int(os.getenv("WARM_POOL_HEADROOM_SECONDS", "900"))
+WARM_POOL_INTERVAL_SECONDS = int(os.getenv("WARM_POOL_INTERVAL_SECONDS", "60"))
+
+# Как часто сверять таблицу users со списками клиентов на серверах WireGuard (в секундах)
+RECONCILE_INTERVAL_SECONDS = int(os.getenv("RECONCILE_INTERVAL_SECONDS", "900"))
+
+# Ограничение нажатий кнопок на пользователя: в секунду и подряд
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "5"))
+
+# Задачи для серверов WireGuard из админки (wg_tasks): размер захватываемой
+# пачки и период опроса очереди (в секундах)
+WG_TASK_BATCH_SIZE = int(os.getenv("WG_TASK_BATCH_SIZE", "100"))
+WG_TASK_POLL_SECONDS = float(os.getenv("WG_TASK_POLL_SECONDS", "5"))
+# Повторы задачи wg_tasks после ошибки: первая пауза (удваивается) и число попыток
+WG_TASK_RETRY_SECONDS = int(os.getenv("WG_TASK_RETRY_SECONDS", "10"))
+WG_TASK_MAX_ATTEMPTS = int(os.getenv("WG_TASK_MAX_ATTEMPTS", "8"))
@@ -0,0 +1,103 @@
+# core/config_cache.py
+
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, Message
+
+from config import CONFIG_CACHE_SIZE
+from core.provisioning import get_configuration
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ConfigArtifact:
+    content: bytes
+    sha256: str
+    # file_id документа, уже загруженного в Telegram (None — ещё не загружали)
+    file_id: Optional[str] = None
+
+
+# config_id → ConfigArtifact, вытеснение самых давно использованных (LRU)
+_cache: "OrderedDict[str, ConfigArtifact]" = OrderedDict()
+
+
+def get(config_id: str) -> Optional[ConfigArtifact]:
+    artifact = _cache.get(config_id)
+    if artifact is not None:
+        _cache.move_to_end(config_id)
+    return artifact
+
+
+def put(config_id: str, content: bytes) -> ConfigArtifact:
+    """
+    Кладёт .conf в кэш. Если содержимое не изменилось, сохраняет уже
+    известный file_id, иначе — сбрасывает его.
+    """
+    sha256 = hashlib.sha256(content).hexdigest()
+    artifact = _cache.get(config_id)
+    if artifact is None or artifact.sha256 != sha256:
+        artifact = ConfigArtifact(content=content, sha256=sha256)
+    _cache[config_id] = artifact
+    _cache.move_to_end(config_id)
+    while len(_cache) > CONFIG_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return artifact
+
+
+def invalidate(config_id: Optional[str]) -> None:
+    # Вызывается при пересоздании и отключении конфига
+    if config_id:
+        _cache.pop(config_id, None)
+
+
+async def send_config_document(
+    message: Message,
+    server_id: int,
+    config_id: str,
+    filename: str,
+) -> None:
+    """
+    Отправляет .conf пользователю в чат message.
+    Может бросить core.provisioning.ProvisioningError, если файл не удалось скачать.
+    """
+    await send_config_to_chat(message.bot, message.chat.id, server_id, config_id, filename)
+
+
+async def send_config_to_chat(
+    bot: Bot,
+    chat_id: int,
+    server_id: int,
+    config_id: str,
+    filename: str,
+) -> None:
+    """
+    Отправляет .conf клиента config_id с сервера server_id в чат chat_id.
+    Повторные отправки идут по file_id — без обращения к API WireGuard и без
+    повторной загрузки файла в Telegram.
+    Может бросить core.provisioning.ProvisioningError, если файл не удалось скачать.
+    """
+    artifact = get(config_id)
+    if artifact is not None and artifact.file_id:
+        try:
+            await bot.send_document(chat_id, artifact.file_id)
+            return
+        except TelegramBadRequest as e:
+            # file_id больше не принимается — загружаем файл заново
+            logger.warning(f"file_id конфига {config_id} отклонён Telegram: {e}")
+            artifact.file_id = None
+
+    if artifact is None:
+        artifact = put(config_id, await get_configuration(server_id, config_id))
+
+    sent = await bot.send_document(
+        chat_id, BufferedInputFile(file=artifact.content, filename=filename)
+    )
+    if sent.document is not None:
+        artifact.file_id = sent.document.file_id
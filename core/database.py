@@ -1,15 +1,31 @@
 # database.py
 
+import asyncio
+import heapq
+import logging
 import os
-from datetime import datetime
-from typing import Optional, List
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, List, Set, Tuple
 
+import asyncpg
 from sqlalchemy import (
     String,
     Integer,
     Boolean,
+    LargeBinary,
+    Text,
     DateTime,
+    Index,
+    case,
+    false,
+    func,
+    literal,
+    or_,
     select,
+    text,
     update,
 )
 from sqlalchemy.ext.asyncio import (
@@ -17,15 +33,35 @@ from sqlalchemy.ext.asyncio import (
     AsyncSession,
     create_async_engine,
 )
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, sessionmaker
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import DeclarativeBase, Mapped, aliased, mapped_column, sessionmaker
 
-from config import DATABASE_URL
+from config import (
+    BOT_MODE,
+    DATABASE_URL,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    WEBHOOK_WORKERS,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    WG_API_URL,
+    WG_API_PASSWORD,
+    WG_SERVER_CAPACITY,
+)
 
-# 1. Создаём асинхронный движок и сессию
+logger = logging.getLogger(__name__)
+
+# 1. Создаём асинхронный движок и сессию.
+#    В режиме webhook у каждого процесса-обработчика свой движок, поэтому пул
+#    реплики делится между ними поровну
+_pool_share = max(1, WEBHOOK_WORKERS) if BOT_MODE == "webhook" else 1
 engine: AsyncEngine = create_async_engine(
     DATABASE_URL,
     echo=False,
     future=True,
+    pool_size=max(1, DB_POOL_SIZE // _pool_share),
+    max_overflow=DB_MAX_OVERFLOW // _pool_share,
 )
 
 AsyncSessionLocal = sessionmaker(
@@ -34,6 +70,54 @@ AsyncSessionLocal = sessionmaker(
     expire_on_commit=False,
 )
 
+# Канал LISTEN/NOTIFY, в который пишутся новые сроки окончания конфигов
+EXPIRY_CHANNEL = "expiry_changed"
+
+# Канал LISTEN/NOTIFY, в который пишутся telegram_id изменённых пользователей
+USER_CHANNEL = "user_changed"
+
+# Канал LISTEN/NOTIFY: появилось новое задание на выдачу конфига
+PROVISION_CHANNEL = "provisioning_job"
+
+# Канал LISTEN/NOTIFY: появились задачи для серверов WireGuard (wg_tasks)
+WG_TASK_CHANNEL = "wg_task"
+
+# Значение в USER_CHANNEL: изменилось много пользователей сразу — сбросить кэш целиком
+ALL_USERS = "*"
+
+# Postgres принимает payload NOTIFY короче 8000 байт
+NOTIFY_PAYLOAD_LIMIT = 8000
+
+# Кэш строк пользователей (telegram_id → (момент устаревания, dict)).
+# TTL + вытеснение самых давно использованных; сбрасывается функциями записи
+# ниже, а изменения из других процессов (админка, другие реплики бота)
+# приходят через USER_CHANNEL — см. run_user_cache_listener.
+_user_cache: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+
+def _user_cache_get(telegram_id: str) -> Optional[dict]:
+    entry = _user_cache.get(telegram_id)
+    if entry is None:
+        return None
+    expires_at, user = entry
+    if expires_at < time.monotonic():
+        del _user_cache[telegram_id]
+        return None
+    _user_cache.move_to_end(telegram_id)
+    return dict(user)
+
+
+def _user_cache_put(telegram_id: str, user: dict) -> None:
+    _user_cache[telegram_id] = (time.monotonic() + USER_CACHE_TTL, user)
+    _user_cache.move_to_end(telegram_id)
+    while len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+
+
+def invalidate_user(*telegram_ids) -> None:
+    for telegram_id in telegram_ids:
+        _user_cache.pop(str(telegram_id), None)
+
 
 # 2. Базовый класс для моделей
 class Base(DeclarativeBase):
@@ -51,18 +135,275 @@ class User(Base):
     trial_config_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     trial_expiration_time: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
     trial_used: Mapped[bool] = mapped_column(Boolean, default=False)
+    trial_status: Mapped[Optional[str]] = mapped_column(String, nullable=True)
 
     config_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     expiration_time: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
     config_status: Mapped[Optional[str]] = mapped_column(String, nullable=True)
 
     notified: Mapped[bool] = mapped_column(Boolean, default=False)
+    # Состояние повторов уведомления об отключении (см. claim_pending_notices)
+    notify_attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    notify_after: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    # Сервер WireGuard, на котором живут клиенты пользователя (servers.id)
+    server_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    # Наименьший отступ (в часах до expiration_time), напоминание за который уже
+    # отправлено; сбрасывается при каждой смене expiration_time
+    reminded_hours: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    __table_args__ = (
+        # Поиск истёкших активных конфигов без полного прохода по таблице
+        Index("ix_users_status_expiration", "config_status", "expiration_time"),
+        Index("ix_users_trial_status_expiration", "trial_status", "trial_expiration_time"),
+        # Снимок клиентов одного сервера для сверки с wg-easy
+        Index("ix_users_server_id", "server_id"),
+        # Фильтр «пробный: да/нет» в списке админки — строки сразу в порядке id
+        Index("ix_users_trial_used_id", "trial_used", "id"),
+        # Очередь неотправленных уведомлений об отключении — только такие строки
+        Index(
+            "ix_users_pending_notify",
+            "notify_after",
+            postgresql_where=text("notified = false AND config_status = 'disabled'"),
+        ),
+    )
+
+
+# 3.1. Задание на выдачу (продление) платного конфига после оплаты.
+#      Ключ идемпотентности — telegram_payment_charge_id: один платёж — одно задание.
+class ProvisioningJob(Base):
+    __tablename__ = "provisioning_jobs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    charge_id: Mapped[str] = mapped_column(String, unique=True, nullable=False)
+    telegram_id: Mapped[str] = mapped_column(String, nullable=False)
+    hours: Mapped[int] = mapped_column(Integer, nullable=False)
+    # pending → done (или failed, если попытки исчерпаны)
+    status: Mapped[str] = mapped_column(String, default="pending", server_default="pending")
+
+    # Результаты выполненных шагов — при повторе они пропускаются
+    config_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    expiration_time: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    wg_enabled: Mapped[bool] = mapped_column(Boolean, default=False, server_default="false")
+
+    attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index(
+            "ix_provisioning_jobs_pending",
+            "next_attempt_at",
+            postgresql_where=text("status = 'pending'"),
+        ),
+    )
+
+
+# 3.2. Журнал платежей. Одна строка на telegram_payment_charge_id —
+#      повторно доставленный Telegram платёж не записывается дважды.
+class Payment(Base):
+    __tablename__ = "payments"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    charge_id: Mapped[str] = mapped_column(String, unique=True, nullable=False)
+    provider_charge_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    telegram_id: Mapped[str] = mapped_column(String, nullable=False)
+    option_key: Mapped[str] = mapped_column(String, nullable=False)
+    # Сумма в минимальных единицах валюты (копейках), как её присылает Telegram
+    amount: Mapped[int] = mapped_column(Integer, nullable=False)
+    currency: Mapped[str] = mapped_column(String, nullable=False)
+    hours: Mapped[int] = mapped_column(Integer, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Платежи пользователя (продления) и выручка по дням
+        Index("ix_payments_telegram_id_created_at", "telegram_id", "created_at"),
+        Index("ix_payments_created_at", "created_at"),
+    )
+
+
+# 3.3. Заранее созданные клиенты WireGuard (тёплый пул) вместе с их .conf.
+#      claimed_at IS NULL — клиент свободен; выданные строки хранятся ещё
+#      WARM_POOL_WINDOW_SECONDS — по ним считается спрос.
+class WarmClient(Base):
+    __tablename__ = "warm_clients"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    server_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    config_id: Mapped[str] = mapped_column(String, unique=True, nullable=False)
+    config: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index(
+            "ix_warm_clients_server_free",
+            "server_id",
+            "id",
+            postgresql_where=text("claimed_at IS NULL"),
+        ),
+        Index("ix_warm_clients_claimed_at", "claimed_at"),
+    )
+
+
+# 3.4. Серверы WireGuard (wg-easy). Новый сервер добавляется строкой в эту
+#      таблицу — без изменений кода; новых пользователей размещают на сервер
+#      с наименьшей загрузкой peer_count / capacity.
+class Server(Base):
+    __tablename__ = "servers"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    name: Mapped[str] = mapped_column(String, unique=True, nullable=False)
+    api_url: Mapped[str] = mapped_column(String, nullable=False)
+    api_password: Mapped[str] = mapped_column(String, nullable=False)
+    capacity: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Клиентов (peer) на сервере, включая свободных из тёплого пула: +1 при
+    # создании клиента через API, точное значение — при сверке со списком
+    # клиентов сервера. Размещение пользователя само peer не создаёт.
+    peer_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    # false — новых пользователей на сервер не размещать
+    enabled: Mapped[bool] = mapped_column(Boolean, default=True, server_default="true")
+
+
+# 3.5. Массовое действие из админки (продление, включение, отключение по фильтру)
+class AdminJob(Base):
+    __tablename__ = "admin_jobs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    action: Mapped[str] = mapped_column(String, nullable=False)
+    # Параметры действия (фильтр, число дней) в JSON — для истории
+    params: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # Сколько пользователей изменено одним UPDATE
+    affected: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+# 3.6. Задача для сервера WireGuard: включить/отключить клиента (outbox).
+#      Пишется в одной транзакции с изменением users — массовыми и одиночными
+#      действиями админки; выполняет handlers/wg_tasks.py на реплике-лидере.
+class WgTask(Base):
+    __tablename__ = "wg_tasks"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    admin_job_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    telegram_id: Mapped[str] = mapped_column(String, nullable=False)
+    server_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    config_id: Mapped[str] = mapped_column(String, nullable=False)
+    # enable | disable
+    action: Mapped[str] = mapped_column(String, nullable=False)
+    # pending → done | failed | superseded (есть более новая задача для того же config_id)
+    status: Mapped[str] = mapped_column(String, default="pending", server_default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    # Не выполнять раньше этого времени (пауза перед повтором после ошибки)
+    next_attempt_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_wg_tasks_pending", "id", postgresql_where=text("status = 'pending'")),
+        # Прогресс массового действия
+        Index("ix_wg_tasks_admin_job_id", "admin_job_id", "status"),
+        # Поиск более новой задачи для того же клиента
+        Index("ix_wg_tasks_config_id", "config_id", "id"),
+    )
 
 
-# 4. Инициализация БД (создаёт таблицы, если их нет)
+# Изменения схемы для уже существующих таблиц (create_all их не применяет).
+# Каждый запрос должен быть идемпотентным — они выполняются при каждом старте.
+_SCHEMA_UPGRADES = [
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS trial_status VARCHAR",
+    # Пробные конфиги, выданные до появления trial_status
+    "UPDATE users SET trial_status = 'active' "
+    "WHERE trial_status IS NULL AND trial_config_id IS NOT NULL",
+    # Однократно при появлении очереди уведомлений: уже отключённым раньше
+    # пользователям повторно о старом отключении не пишем
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'users' AND column_name = 'notify_attempts'
+        ) THEN
+            ALTER TABLE users ADD COLUMN notify_attempts INTEGER NOT NULL DEFAULT 0;
+            UPDATE users SET notified = true WHERE config_status = 'disabled';
+        END IF;
+    END $$
+    """,
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS notify_after TIMESTAMP WITHOUT TIME ZONE",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS reminded_hours INTEGER",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS server_id INTEGER",
+    # Поиск в админке по подстроке telegram_id/username — триграммные GIN-индексы.
+    # Без прав на CREATE EXTENSION бот работает, а поиск просто идёт без индекса
+    """
+    DO $$
+    BEGIN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    EXCEPTION WHEN insufficient_privilege THEN
+        RAISE NOTICE 'pg_trgm недоступен, поиск в админке будет без индекса';
+    END $$
+    """,
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+            CREATE INDEX IF NOT EXISTS ix_users_telegram_id_trgm
+                ON users USING gin (telegram_id gin_trgm_ops);
+            CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+                ON users USING gin (username gin_trgm_ops);
+        END IF;
+    END $$
+    """,
+    # Всё, что создано до появления реестра серверов, живёт на сервере «default»
+    "UPDATE users SET server_id = (SELECT id FROM servers WHERE name = 'default') "
+    "WHERE server_id IS NULL AND (config_id IS NOT NULL OR trial_config_id IS NOT NULL)",
+]
+
+# Сервер «default» из WG_API_URL — чтобы существующая установка работала без настройки.
+# Адрес и пароль обновляются при каждом старте (источник — переменные окружения),
+# ёмкость задаётся только при создании строки и дальше меняется в таблице
+_SEED_DEFAULT_SERVER = """
+    INSERT INTO servers (name, api_url, api_password, capacity, peer_count, enabled)
+    SELECT 'default', :api_url, :api_password, :capacity,
+           (SELECT count(config_id) + count(trial_config_id) FROM users), true
+    ON CONFLICT (name) DO UPDATE
+    SET api_url = EXCLUDED.api_url, api_password = EXCLUDED.api_password
+"""
+
+
+def _create_missing_indexes(sync_conn) -> None:
+    # create_all не добавляет новые индексы к уже существующим таблицам
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
+@asynccontextmanager
+async def _use_session(session: Optional[AsyncSession] = None):
+    """
+    Если передана сессия апдейта (см. middlewares/database.py), работаем в ней —
+    commit сделает middleware в конце обработки. Иначе открываем короткую
+    сессию и коммитим её сами.
+    """
+    if session is not None:
+        yield session
+        return
+    async with AsyncSessionLocal() as own_session:
+        yield own_session
+        await own_session.commit()
+
+
+# 4. Инициализация БД (создаёт таблицы, недостающие колонки и индексы)
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(
+            text(_SEED_DEFAULT_SERVER),
+            {"api_url": WG_API_URL, "api_password": WG_API_PASSWORD, "capacity": WG_SERVER_CAPACITY},
+        )
+        for statement in _SCHEMA_UPGRADES:
+            await conn.execute(text(statement))
+        await conn.run_sync(_create_missing_indexes)
 
 
 # 5. Отключение от БД
@@ -70,32 +411,68 @@ async def shutdown_db():
     await engine.dispose()
 
 
-# 6. Добавить пользователя (если нет) или просто вернуть существующего
-async def add_user(telegram_id: int, username: Optional[str] = None) -> None:
-    async with AsyncSessionLocal() as session:
-        new = User(telegram_id=str(telegram_id), username=username)
-        session.add(new)
-        try:
-            await session.commit()
-        except Exception:
-            await session.rollback()
-        # Не обязательно возвращать объект
-
+# 6. Зарегистрировать пользователя или обновить username одним запросом
+#    INSERT ... ON CONFLICT (telegram_id) DO UPDATE ... RETURNING *.
+#    user — уже загруженная строка (например, из DbSessionMiddleware): если
+#    username не изменился, в БД не пишем вовсе.
+async def register_user(
+    telegram_id: int,
+    username: Optional[str] = None,
+    session: Optional[AsyncSession] = None,
+    user: Optional[dict] = None,
+) -> dict:
+    if user is not None and user.get("username") == username:
+        return user
 
-# 7. Обновить или установить username
-async def add_username(telegram_id: int, username: Optional[str]) -> None:
-    async with AsyncSessionLocal() as session:
-        await session.execute(
-            update(User)
-            .where(User.telegram_id == str(telegram_id))
-            .values(username=username)
+    stmt = pg_insert(User).values(telegram_id=str(telegram_id), username=username)
+    stmt = (
+        stmt.on_conflict_do_update(
+            index_elements=[User.telegram_id],
+            set_={"username": stmt.excluded.username},
+            # Не переписываем строку, если username тот же
+            where=User.username.is_distinct_from(stmt.excluded.username),
         )
-        await session.commit()
+        .returning(User)
+        .execution_options(populate_existing=True)
+    )
+    async with _use_session(session) as session:
+        user_obj = (await session.execute(stmt)).scalars().first()
+        if user_obj is None:
+            # Конфликт без изменений — RETURNING пуст, читаем строку как есть
+            result = await session.execute(
+                select(User).where(User.telegram_id == str(telegram_id))
+            )
+            user_obj = result.scalars().one()
+        else:
+            await notify_user_change(session, telegram_id)
+        return _user_to_dict(user_obj)
 
 
-# 8. Получить все данные пользователя как dict или None
-async def get_user(telegram_id: int) -> Optional[dict]:
-    async with AsyncSessionLocal() as session:
+# 7. Строка пользователя в виде dict
+def _user_to_dict(user_obj: User) -> dict:
+    return {
+        "id": user_obj.id,
+        "telegram_id": user_obj.telegram_id,
+        "username": user_obj.username,
+        "trial_config_id": user_obj.trial_config_id,
+        "trial_expiration_time": user_obj.trial_expiration_time,
+        "trial_used": user_obj.trial_used,
+        "trial_status": user_obj.trial_status,
+        "config_id": user_obj.config_id,
+        "expiration_time": user_obj.expiration_time,
+        "config_status": user_obj.config_status,
+        "notified": user_obj.notified,
+        "server_id": user_obj.server_id,
+    }
+
+
+# 8. Получить все данные пользователя как dict или None (через кэш строк пользователей)
+async def get_user(telegram_id: int, session: Optional[AsyncSession] = None) -> Optional[dict]:
+    cached = _user_cache_get(str(telegram_id))
+    if cached is not None:
+        return cached
+
+    async with _use_session(session) as session:
         result = await session.execute(
             select(User).where(User.telegram_id == str(telegram_id))
         )
@@ -103,154 +480,847 @@ async def get_user(telegram_id: int) -> Optional[dict]:
         if not user_obj:
             return None
 
-        return {
-            "id": user_obj.id,
-            "telegram_id": user_obj.telegram_id,
-            "username": user_obj.username,
-            "trial_config_id": user_obj.trial_config_id,
-            "trial_expiration_time": user_obj.trial_expiration_time,
-            "trial_used": user_obj.trial_used,
-            "config_id": user_obj.config_id,
-            "expiration_time": user_obj.expiration_time,
-            "config_status": user_obj.config_status,
-            "notified": user_obj.notified,
-        }
+        user = _user_to_dict(user_obj)
+        _user_cache_put(user["telegram_id"], user)
+        return dict(user)
 
 
-# 9. Получить только config_id
-async def get_conf_id(telegram_id: int) -> Optional[str]:
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(User.config_id).where(User.telegram_id == str(telegram_id))
+# 9. Сохранить config_id (платный или пробный)
+async def save_config_id(
+    telegram_id: int,
+    config_id: str,
+    session: Optional[AsyncSession] = None,
+) -> None:
+    async with _use_session(session) as session:
+        await session.execute(
+            update(User)
+            .where(User.telegram_id == str(telegram_id))
+            .values(config_id=config_id)
         )
-        row = result.scalar_one_or_none()
-        return row
+        await notify_user_change(session, telegram_id)
 
 
-# 10. Сохранить config_id (платный или пробный)
-async def save_config_id(telegram_id: int, config_id: str) -> None:
-    async with AsyncSessionLocal() as session:
+# 10. Выдать пробный конфиг: config_id, срок окончания, trial_used и статус
+#     записываются одним UPDATE — строка сразу попадает под отключение по сроку,
+#     даже если отправить .conf пользователю потом не удастся
+async def save_trial_config_id(
+    telegram_id: int,
+    config_id: str,
+    expiration_time: datetime,
+    session: Optional[AsyncSession] = None,
+) -> None:
+    async with _use_session(session) as session:
         await session.execute(
             update(User)
             .where(User.telegram_id == str(telegram_id))
-            .values(config_id=config_id)
+            .values(
+                trial_config_id=config_id,
+                trial_expiration_time=expiration_time,
+                trial_used=True,
+                trial_status="active",
+            )
         )
-        await session.commit()
+        await notify_user_change(session, telegram_id)
+        await notify_expiration_change(session, expiration_time)
 
 
-# 11. Сохранить trial_config_id
-async def save_trial_config_id(telegram_id: int, config_id: str) -> None:
-    async with AsyncSessionLocal() as session:
+def _expiry_columns(trial: bool):
+    # (статус, срок окончания, id конфига) для платного или пробного конфига
+    if trial:
+        return User.trial_status, User.trial_expiration_time, User.trial_config_id
+    return User.config_status, User.expiration_time, User.config_id
+
+
+# 11. Захватить пачку активных конфигов с истёкшим сроком (платных или, при trial=True, пробных).
+#     SELECT ... FOR UPDATE SKIP LOCKED: строки остаются заблокированными до конца
+#     транзакции session, поэтому параллельные обработчики (в том числе в других
+#     репликах) получают непересекающиеся пачки. Идёт по индексу
+#     ix_users_status_expiration / ix_users_trial_status_expiration;
+#     exclude_ids — users.id, которые в этом проходе уже не удалось отключить.
+async def claim_expired_configs(
+    session: AsyncSession,
+    now: datetime,
+    limit: int = 100,
+    trial: bool = False,
+    exclude_ids: Iterable[int] = (),
+) -> List[dict]:
+    status_col, exp_col, config_col = _expiry_columns(trial)
+    query = (
+        select(
+            User.id,
+            User.telegram_id,
+            config_col.label("config_id"),
+            exp_col.label("expiration_time"),
+            User.notified,
+            # Для пробных: платный конфиг пользователя, чтобы не отключить его по ошибке
+            User.config_id.label("paid_config_id"),
+            User.config_status.label("paid_status"),
+            User.server_id,
+        )
+        .where(
+            status_col == "active",
+            exp_col <= now,
+            config_col.is_not(None),
+        )
+        .order_by(exp_col)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    exclude_ids = list(exclude_ids)
+    if exclude_ids:
+        query = query.where(User.id.not_in(exclude_ids))
+
+    result = await session.execute(query)
+    return [dict(row._mapping) for row in result]
+
+
+# 12. Отключить пачку конфигов одним UPDATE.
+#     Для платных уведомление ставится в очередь (notified = false) —
+#     его отправит deliver_expiry_notices из handlers/auto_disable.py.
+async def mark_configs_disabled(
+    telegram_ids: List[str],
+    trial: bool = False,
+    session: Optional[AsyncSession] = None,
+) -> None:
+    if not telegram_ids:
+        return
+    if trial:
+        values = {"trial_status": "disabled"}
+    else:
+        values = {
+            "config_status": "disabled",
+            "notified": False,
+            "notify_attempts": 0,
+            "notify_after": None,
+        }
+    async with _use_session(session) as session:
         await session.execute(
             update(User)
-            .where(User.telegram_id == str(telegram_id))
-            .values(trial_config_id=config_id)
+            .where(User.telegram_id.in_(telegram_ids))
+            .values(**values)
+            .execution_options(synchronize_session=False)
         )
+        await notify_user_change(session, *telegram_ids)
+
+
+# 13. Сроки окончания активных конфигов (платных и пробных) не позже until,
+#     включая уже прошедшие — отсортированы по возрастанию
+async def get_upcoming_expirations(until: datetime) -> List[datetime]:
+    deadlines = []
+    async with AsyncSessionLocal() as session:
+        for trial in (False, True):
+            status_col, exp_col, config_col = _expiry_columns(trial)
+            result = await session.execute(
+                select(exp_col)
+                .where(
+                    status_col == "active",
+                    exp_col <= until,
+                    config_col.is_not(None),
+                )
+                .order_by(exp_col)
+            )
+            deadlines = list(heapq.merge(deadlines, result.scalars().all()))
+    return deadlines
+
+
+# 14. Сообщить планировщику отключений о новом сроке окончания.
+#     NOTIFY доставляется только после commit транзакции session,
+#     поэтому работает и из админки (отдельный процесс со своим движком).
+async def notify_expiration_change(session: AsyncSession, expiration_time: datetime) -> None:
+    await session.execute(select(func.pg_notify(EXPIRY_CHANNEL, expiration_time.isoformat())))
+
+
+# 15. Сообщить всем процессам, что строки пользователей изменились.
+#     Локальный кэш сбрасываем сразу, остальные процессы (и повторно этот же —
+#     чтобы убрать значения, прочитанные до commit) — по NOTIFY после commit.
+#     Если список id не помещается в payload, кэш сбрасывается целиком.
+async def notify_user_change(session: AsyncSession, *telegram_ids) -> None:
+    payload = ",".join(str(telegram_id) for telegram_id in telegram_ids)
+    if len(payload.encode()) >= NOTIFY_PAYLOAD_LIMIT:
+        await notify_all_users_changed(session)
+        return
+    invalidate_user(*telegram_ids)
+    await session.execute(select(func.pg_notify(USER_CHANNEL, payload)))
+
+
+# 16. Отдельное (не из пула) соединение asyncpg — для LISTEN и advisory-блокировок,
+#     которые живут столько же, сколько само соединение
+async def connect_raw() -> asyncpg.Connection:
+    dsn = make_url(DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+    return await asyncpg.connect(dsn)
+
+
+# 17. Подписаться на канал LISTEN/NOTIFY.
+#     Возвращает соединение, которое нужно держать открытым;
+#     callback(payload) вызывается на каждое уведомление.
+async def listen(channel: str, callback) -> asyncpg.Connection:
+    conn = await connect_raw()
+    await conn.add_listener(channel, lambda _conn, _pid, _channel, payload: callback(payload))
+    return conn
+
+
+def _on_user_notify(payload: str) -> None:
+    if payload == ALL_USERS:
+        _user_cache.clear()
+    else:
+        invalidate_user(*payload.split(","))
+
+
+# 18. Фоновая задача: держит подписку на USER_CHANNEL и переподключается при обрыве.
+#     Пока подписки нет, уведомления теряются, поэтому после обрыва кэш очищается целиком.
+async def run_user_cache_listener(check_interval: float = 5) -> None:
+    while True:
+        conn = None
+        try:
+            conn = await listen(USER_CHANNEL, _on_user_notify)
+            _user_cache.clear()
+            while not conn.is_closed():
+                await asyncio.sleep(check_interval)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка подписки на {USER_CHANNEL}: {e}")
+        finally:
+            _user_cache.clear()
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(check_interval)
+
+
+# 19. Захватить пачку неотправленных уведомлений об отключении платного конфига,
+#     у которых подошло время очередной попытки. FOR UPDATE SKIP LOCKED, по
+#     частичному индексу ix_users_pending_notify.
+async def claim_pending_notices(session: AsyncSession, now: datetime, limit: int = 100) -> List[dict]:
+    result = await session.execute(
+        select(User.telegram_id, User.notify_attempts)
+        .where(
+            # = false, а не IS false — иначе не совпадает с условием частичного индекса
+            User.notified == false(),
+            User.config_status == "disabled",
+            or_(User.notify_after.is_(None), User.notify_after <= now),
+        )
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return [dict(row._mapping) for row in result]
+
+
+# 20. Записать итог рассылки пачки одним UPDATE:
+#     done_ids — доставлено (или доставить невозможно), retry_at — telegram_id → время повтора
+async def record_notice_results(
+    session: AsyncSession,
+    done_ids: List[str],
+    retry_at: Dict[str, datetime],
+) -> None:
+    ids = list(done_ids) + list(retry_at)
+    if not ids:
+        return
+    values = {"notified": User.telegram_id.in_(list(done_ids))}
+    if retry_at:
+        values["notify_attempts"] = case(
+            (User.telegram_id.in_(list(retry_at)), User.notify_attempts + 1),
+            else_=User.notify_attempts,
+        )
+        values["notify_after"] = case(retry_at, value=User.telegram_id, else_=None)
+    await session.execute(
+        update(User)
+        .where(User.telegram_id.in_(ids))
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    await notify_user_change(session, *ids)
+
+
+# 21. Захватить пачку активных платных конфигов, которым пора отправить напоминание
+#     за offset_hours часов: срок в окне (now, now + offset_hours] и напоминания
+#     за этот или меньший отступ ещё не было. Диапазонный запрос по индексу
+#     ix_users_status_expiration, FOR UPDATE SKIP LOCKED.
+async def claim_due_reminders(
+    session: AsyncSession,
+    now: datetime,
+    offset_hours: int,
+    limit: int = 100,
+    exclude_ids: Iterable[int] = (),
+) -> List[dict]:
+    query = (
+        select(User.id, User.telegram_id, User.expiration_time)
+        .where(
+            User.config_status == "active",
+            User.expiration_time > now,
+            User.expiration_time <= now + timedelta(hours=offset_hours),
+            or_(User.reminded_hours.is_(None), User.reminded_hours > offset_hours),
+        )
+        .order_by(User.expiration_time)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    exclude_ids = list(exclude_ids)
+    if exclude_ids:
+        query = query.where(User.id.not_in(exclude_ids))
+
+    result = await session.execute(query)
+    return [dict(row._mapping) for row in result]
+
+
+# 22. Отметить одним UPDATE, что напоминание за offset_hours часов отправлено
+async def mark_reminded(session: AsyncSession, telegram_ids: List[str], offset_hours: int) -> None:
+    if not telegram_ids:
+        return
+    await session.execute(
+        update(User)
+        .where(User.telegram_id.in_(telegram_ids))
+        .values(reminded_hours=offset_hours)
+        .execution_options(synchronize_session=False)
+    )
+    await notify_user_change(session, *telegram_ids)
+
+
+# 23. Поставить задание на выдачу конфига по платежу.
+#     INSERT ... ON CONFLICT (charge_id) DO NOTHING: повторная доставка того же
+#     платежа задание не дублирует. Возвращает, создано ли задание.
+async def enqueue_provisioning_job(
+    charge_id: str,
+    telegram_id: int,
+    hours: int,
+    session: Optional[AsyncSession] = None,
+) -> bool:
+    async with _use_session(session) as session:
+        result = await session.execute(
+            pg_insert(ProvisioningJob)
+            .values(
+                charge_id=charge_id,
+                telegram_id=str(telegram_id),
+                hours=hours,
+                next_attempt_at=datetime.utcnow(),
+                created_at=datetime.utcnow(),
+            )
+            .on_conflict_do_nothing(index_elements=[ProvisioningJob.charge_id])
+            .returning(ProvisioningJob.id)
+        )
+        created = result.scalar_one_or_none() is not None
+        if created:
+            # Обработчики проснутся после commit
+            await session.execute(select(func.pg_notify(PROVISION_CHANNEL, charge_id)))
+        return created
+
+
+def _job_to_dict(job: ProvisioningJob) -> dict:
+    return {
+        "id": job.id,
+        "charge_id": job.charge_id,
+        "telegram_id": job.telegram_id,
+        "hours": job.hours,
+        "config_id": job.config_id,
+        "expiration_time": job.expiration_time,
+        "wg_enabled": job.wg_enabled,
+        "attempts": job.attempts,
+    }
+
+
+# 24. Захватить одно готовое к выполнению задание (FOR UPDATE SKIP LOCKED) и
+#     сразу продлить его next_attempt_at на lease секунд: пока обработчик работает,
+#     задание не возьмёт никто другой, а если он упадёт — задание вернётся в работу.
+async def claim_provisioning_job(now: datetime, lease: float) -> Optional[dict]:
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(ProvisioningJob)
+            .where(ProvisioningJob.status == "pending", ProvisioningJob.next_attempt_at <= now)
+            .order_by(ProvisioningJob.next_attempt_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        job = result.scalars().first()
+        if job is None:
+            return None
+        job.attempts += 1
+        job.next_attempt_at = now + timedelta(seconds=lease)
         await session.commit()
+        return _job_to_dict(job)
 
 
-# 12. Установить время окончания для платного конфига
-async def set_expiration_time(telegram_id: int, expiration_time: datetime) -> None:
+# 25. Сохранить config_id клиента сразу у пользователя и в задании
+async def save_job_config_id(
+    job_id: int,
+    telegram_id: str,
+    config_id: str,
+    session: Optional[AsyncSession] = None,
+) -> None:
+    async with _use_session(session) as session:
+        await session.execute(
+            update(ProvisioningJob).where(ProvisioningJob.id == job_id).values(config_id=config_id)
+        )
+        await save_config_id(telegram_id, config_id, session=session)
+
+
+# 26. Продлить срок и включить платный конфиг по заданию — в одной транзакции
+#     с отметкой в задании, поэтому срок продлевается ровно один раз на платёж.
+#     Возвращает новое время окончания.
+async def apply_provisioning_job(job_id: int) -> datetime:
     async with AsyncSessionLocal() as session:
+        job = (
+            await session.execute(
+                select(ProvisioningJob).where(ProvisioningJob.id == job_id).with_for_update()
+            )
+        ).scalar_one()
+        if job.expiration_time is not None:
+            return job.expiration_time
+
+        old_exp = (
+            await session.execute(
+                select(User.expiration_time)
+                .where(User.telegram_id == job.telegram_id)
+                .with_for_update()
+            )
+        ).scalar_one_or_none()
+        now = datetime.utcnow()
+        # Если старый срок ещё не истёк — продлеваем от него, иначе от текущего момента
+        new_exp = max(old_exp or now, now) + timedelta(hours=job.hours)
+
         await session.execute(
             update(User)
-            .where(User.telegram_id == str(telegram_id))
-            .values(expiration_time=expiration_time)
+            .where(User.telegram_id == job.telegram_id)
+            .values(expiration_time=new_exp, config_status="active", reminded_hours=None)
         )
+        job.expiration_time = new_exp
+        await notify_user_change(session, job.telegram_id)
+        await notify_expiration_change(session, new_exp)
         await session.commit()
+        return new_exp
 
 
-# 13. Установить время окончания для trial
-async def set_trial_expiration_time(telegram_id: int, expiration_time: datetime) -> None:
+# 27. Обновить поля задания (шаги, статус, время повтора)
+async def update_provisioning_job(job_id: int, **values) -> None:
     async with AsyncSessionLocal() as session:
         await session.execute(
-            update(User)
-            .where(User.telegram_id == str(telegram_id))
-            .values(trial_expiration_time=expiration_time)
+            update(ProvisioningJob).where(ProvisioningJob.id == job_id).values(**values)
         )
         await session.commit()
 
 
-# 14. Получить expiration_time (платный)
-async def get_expiration_time(telegram_id: int) -> Optional[datetime]:
-    async with AsyncSessionLocal() as session:
+# 28. Записать платёж в журнал.
+#     INSERT ... ON CONFLICT (charge_id) DO NOTHING — возвращает False,
+#     если этот платёж уже был записан (повторная доставка апдейта).
+async def record_payment(
+    charge_id: str,
+    provider_charge_id: Optional[str],
+    telegram_id: int,
+    option_key: str,
+    amount: int,
+    currency: str,
+    hours: int,
+    session: Optional[AsyncSession] = None,
+) -> bool:
+    async with _use_session(session) as session:
         result = await session.execute(
-            select(User.expiration_time).where(User.telegram_id == str(telegram_id))
+            pg_insert(Payment)
+            .values(
+                charge_id=charge_id,
+                provider_charge_id=provider_charge_id,
+                telegram_id=str(telegram_id),
+                option_key=option_key,
+                amount=amount,
+                currency=currency,
+                hours=hours,
+                created_at=datetime.utcnow(),
+            )
+            .on_conflict_do_nothing(index_elements=[Payment.charge_id])
+            .returning(Payment.id)
         )
-        row = result.scalar_one_or_none()
-        return row
+        return result.scalar_one_or_none() is not None
+
 
+# 29. Забрать один свободный клиент сервера server_id из тёплого пула (FOR UPDATE SKIP LOCKED).
+#     Клиент считается выданным только после commit транзакции session — при
+#     откате он возвращается в пул. Возвращает {"config_id", "config"} или None.
+async def claim_warm_client(session: AsyncSession, server_id: int) -> Optional[dict]:
+    free = (
+        select(WarmClient.id)
+        .where(WarmClient.claimed_at.is_(None), WarmClient.server_id == server_id)
+        .order_by(WarmClient.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    result = await session.execute(
+        update(WarmClient)
+        .where(WarmClient.id == free)
+        .values(claimed_at=datetime.utcnow())
+        .returning(WarmClient.config_id, WarmClient.config)
+        .execution_options(synchronize_session=False)
+    )
+    row = result.first()
+    return dict(row._mapping) if row else None
 
-# 15. Проверить, использовал ли пользователь trial
-async def has_used_trial(telegram_id: int) -> bool:
+
+# 30. Состояние тёплого пула по серверам:
+#     server_id → (свободных клиентов, выдано за время с since)
+async def get_warm_pool_stats(since: datetime) -> Dict[int, Tuple[int, int]]:
     async with AsyncSessionLocal() as session:
         result = await session.execute(
-            select(User.trial_used).where(User.telegram_id == str(telegram_id))
+            select(
+                WarmClient.server_id,
+                func.count().filter(WarmClient.claimed_at.is_(None)),
+                func.count().filter(WarmClient.claimed_at >= since),
+            )
+            .group_by(WarmClient.server_id)
         )
-        row = result.scalar_one_or_none()
-        return bool(row) if row is not None else False
+        return {server_id: (free, claimed) for server_id, free, claimed in result}
+
+
+# 31. Добавить созданного клиента в тёплый пул сервера server_id
+async def add_warm_client(server_id: int, config_id: str, config: bytes) -> None:
+    async with AsyncSessionLocal() as session:
+        session.add(WarmClient(
+            server_id=server_id,
+            config_id=config_id,
+            config=config,
+            created_at=datetime.utcnow(),
+        ))
+        await session.commit()
 
 
-# 16. Пометить, что trial использован
-async def set_trial_used(telegram_id: int, used: bool = True) -> None:
+# 32. Удалить записи о клиентах, выданных раньше before (для подсчёта спроса они уже не нужны)
+async def purge_claimed_warm_clients(before: datetime) -> None:
     async with AsyncSessionLocal() as session:
         await session.execute(
-            update(User)
-            .where(User.telegram_id == str(telegram_id))
-            .values(trial_used=used)
+            WarmClient.__table__.delete().where(WarmClient.claimed_at < before)
         )
         await session.commit()
 
 
-# 17. Включить платный конфиг (пометить статус=active)
-async def enable_config(telegram_id: int) -> None:
+def _server_to_dict(server: Server) -> dict:
+    return {
+        "id": server.id,
+        "name": server.name,
+        "api_url": server.api_url,
+        "api_password": server.api_password,
+        "capacity": server.capacity,
+        "peer_count": server.peer_count,
+        "enabled": server.enabled,
+    }
+
+
+# 33. Сервер по id (dict) или None
+async def get_server(server_id: int) -> Optional[dict]:
     async with AsyncSessionLocal() as session:
+        server = await session.get(Server, server_id)
+        return _server_to_dict(server) if server else None
+
+
+# 34. Все серверы (или только включённые)
+async def list_servers(enabled_only: bool = False) -> List[dict]:
+    async with AsyncSessionLocal() as session:
+        query = select(Server).order_by(Server.id)
+        if enabled_only:
+            query = query.where(Server.enabled.is_(True))
+        result = await session.execute(query)
+        return [_server_to_dict(server) for server in result.scalars().all()]
+
+
+# 35. Сервер пользователя; если его ещё нет — разместить пользователя на
+#     включённый сервер с наименьшей загрузкой (peer_count / capacity), где
+#     есть место для нового клиента или свободный клиент в тёплом пуле.
+#     peer_count здесь не меняется: его увеличивает создание клиента (add_server_peers).
+#     Всё выполняется в session апдейта — без второго соединения из пула; строка
+#     сервера не блокируется, поэтому одновременные размещения могут ненадолго
+#     превысить capacity на несколько клиентов (ёмкость — мягкий предел).
+#     server_id записывается только если он ещё пуст (UPDATE ... WHERE server_id
+#     IS NULL): из двух одновременных размещений одного пользователя (пробный и
+#     задание на выдачу, два задания) побеждает первое, второе получает его сервер.
+#     Возвращает None, если свободных мест нет ни на одном сервере.
+async def assign_user_server(session: AsyncSession, telegram_id: int) -> Optional[int]:
+    current = (
+        await session.execute(select(User.server_id).where(User.telegram_id == str(telegram_id)))
+    ).scalar_one_or_none()
+    if current is not None:
+        return current
+
+    has_free_warm = (
+        select(WarmClient.id)
+        .where(WarmClient.server_id == Server.id, WarmClient.claimed_at.is_(None))
+        .exists()
+    )
+    least_loaded = (
+        select(Server.id)
+        .where(
+            Server.enabled.is_(True),
+            # capacity = 0 — сервер выводится из работы, новых пользователей на него не размещаем
+            Server.capacity > 0,
+            or_(Server.peer_count < Server.capacity, has_free_warm),
+        )
+        .order_by(Server.peer_count * 1.0 / func.nullif(Server.capacity, 0), Server.id)
+        .limit(1)
+    )
+    server_id = (await session.execute(least_loaded)).scalar_one_or_none()
+    if server_id is None:
+        return None
+
+    assigned = (
         await session.execute(
             update(User)
-            .where(User.telegram_id == str(telegram_id))
-            .values(config_status="active")
+            .where(User.telegram_id == str(telegram_id), User.server_id.is_(None))
+            .values(server_id=server_id)
+            .returning(User.server_id)
         )
-        await session.commit()
+    ).scalar_one_or_none()
+    if assigned is None:
+        # Пользователя уже разместила параллельная транзакция — берём её сервер
+        return (
+            await session.execute(select(User.server_id).where(User.telegram_id == str(telegram_id)))
+        ).scalar_one_or_none()
+
+    await notify_user_change(session, telegram_id)
+    return assigned
+
+
+# 36. Снимок ожидаемого состояния клиентов сервера для сверки:
+#     config_id → должен ли клиент быть включён. Один запрос по ix_users_server_id.
+#     Активный конфиг с уже истёкшим сроком считается отключённым — его вот-вот
+#     отключит auto_disable, и включать его обратно нельзя. Если пробный и
+#     платный — один клиент, он включён, пока действует хотя бы один из них.
+async def get_server_config_states(server_id: int, now: datetime) -> Dict[str, bool]:
+    states: Dict[str, bool] = {}
 
+    def _set(config_id: Optional[str], status: Optional[str], expiration: Optional[datetime]):
+        if config_id:
+            enabled = status == "active" and (expiration is None or expiration > now)
+            states[config_id] = states.get(config_id, False) or enabled
 
-# 18. Отключить конфиг (config_status = 'disabled')
-async def disable_config(telegram_id: int) -> None:
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(
+                User.config_id,
+                User.config_status,
+                User.expiration_time,
+                User.trial_config_id,
+                User.trial_status,
+                User.trial_expiration_time,
+            ).where(User.server_id == server_id)
+        )
+        for row in result:
+            _set(row.config_id, row.config_status, row.expiration_time)
+            _set(row.trial_config_id, row.trial_status, row.trial_expiration_time)
+    return states
+
+
+# 37. id свободных клиентов тёплого пула сервера (они включены, но ещё ничьи)
+async def get_warm_config_ids(server_id: int) -> Set[str]:
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(WarmClient.config_id).where(
+                WarmClient.server_id == server_id,
+                WarmClient.claimed_at.is_(None),
+            )
+        )
+        return set(result.scalars().all())
+
+
+# 38. Записать фактическое число клиентов на сервере (по результатам сверки)
+async def set_server_peer_count(server_id: int, peer_count: int) -> None:
     async with AsyncSessionLocal() as session:
         await session.execute(
-            update(User)
-            .where(User.telegram_id == str(telegram_id))
-            .values(config_status="disabled")
+            update(Server).where(Server.id == server_id).values(peer_count=peer_count)
         )
         await session.commit()
 
 
-# 19. Получить всех пользователей (возвращает список dict)
-async def get_all_users() -> List[dict]:
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(select(User))
-        users = result.scalars().all()
-        return [
-            {
-                "id": u.id,
-                "telegram_id": u.telegram_id,
-                "username": u.username,
-                "trial_used": u.trial_used,
-                "trial_expiration_time": u.trial_expiration_time,
-                "config_id": u.config_id,
-                "expiration_time": u.expiration_time,
-                "config_status": u.config_status,
-                "notified": u.notified,
-            }
-            for u in users
-        ]
-
-
-# 20. Пометить, что пользователю отправили уведомление
-async def mark_as_notified(telegram_id: int) -> None:
+# 39. Учесть count новых клиентов, созданных на сервере через API.
+#     Отдельная короткая транзакция: клиент на сервере уже существует,
+#     даже если транзакция вызывающего потом откатится.
+async def add_server_peers(server_id: int, count: int = 1) -> None:
     async with AsyncSessionLocal() as session:
         await session.execute(
-            update(User)
-            .where(User.telegram_id == str(telegram_id))
-            .values(notified=True)
+            update(Server).where(Server.id == server_id).values(peer_count=Server.peer_count + count)
         )
         await session.commit()
+
+
+# 40. Сообщить всем процессам, что изменилось много пользователей сразу
+#     (payload NOTIFY ограничен NOTIFY_PAYLOAD_LIMIT байт — список id туда не поместится)
+async def notify_all_users_changed(session: AsyncSession) -> None:
+    _user_cache.clear()
+    await session.execute(select(func.pg_notify(USER_CHANNEL, ALL_USERS)))
+
+
+# 41. Массовое действие над пользователями, подходящими под conditions:
+#     один UPDATE ... RETURNING, результат которого тем же запросом (CTE)
+#     превращается в задачи wg_tasks для серверов WireGuard. Всё — в транзакции
+#     session; изменения и задачи появляются одновременно после commit.
+#     action: "extend" — продлить активным срок на days дней;
+#             "enable" — включить платный конфиг на days дней (от текущего срока, если он ещё не истёк);
+#             "disable" — отключить активные платные конфиги (без уведомления пользователю).
+#     Возвращает id записи admin_jobs.
+async def run_bulk_action(
+    session: AsyncSession,
+    action: str,
+    conditions: list,
+    days: int = 0,
+    params: Optional[str] = None,
+) -> int:
+    now = datetime.utcnow()
+    delta = timedelta(days=days)
+    if action == "extend":
+        conditions = [*conditions, User.config_status == "active", User.expiration_time.is_not(None)]
+        values = {"expiration_time": User.expiration_time + delta, "reminded_hours": None}
+        task_action = None
+    elif action == "enable":
+        conditions = [*conditions, User.config_id.is_not(None)]
+        values = {
+            "config_status": "active",
+            "expiration_time": func.greatest(func.coalesce(User.expiration_time, now), now) + delta,
+            "reminded_hours": None,
+        }
+        task_action = "enable"
+    elif action == "disable":
+        conditions = [*conditions, User.config_status == "active", User.config_id.is_not(None)]
+        values = {"config_status": "disabled", "notified": True}
+        task_action = "disable"
+    else:
+        raise ValueError(f"Неизвестное массовое действие: {action}")
+
+    job = AdminJob(action=action, params=params, created_at=now)
+    session.add(job)
+    await session.flush()
+
+    changed = (
+        update(User)
+        .where(*conditions)
+        .values(**values)
+        .returning(User.telegram_id, User.server_id, User.config_id)
+        .cte("changed")
+    )
+    if task_action is None:
+        affected = (await session.execute(select(func.count()).select_from(changed))).scalar_one()
+    else:
+        result = await session.execute(
+            WgTask.__table__.insert()
+            .from_select(
+                ["admin_job_id", "telegram_id", "server_id", "config_id", "action", "status", "created_at"],
+                select(
+                    literal(job.id),
+                    changed.c.telegram_id,
+                    changed.c.server_id,
+                    changed.c.config_id,
+                    literal(task_action),
+                    literal("pending"),
+                    literal(now),
+                ),
+            )
+        )
+        affected = result.rowcount
+        await session.execute(select(func.pg_notify(WG_TASK_CHANNEL, str(job.id))))
+
+    job.affected = affected
+    await notify_all_users_changed(session)
+    if action in ("extend", "enable") and affected:
+        # Планировщик отключений пересчитает ближайшие сроки
+        await notify_expiration_change(session, now + delta)
+    return job.id
+
+
+# 42. Захватить пачку задач wg_tasks, которые пора выполнять (FOR UPDATE SKIP LOCKED).
+#     Для каждого config_id выполняется только последняя задача: более старые
+#     помечаются superseded — иначе повтор старой задачи после ошибки мог бы
+#     откатить более новое действие (например, снова включить отключённого).
+async def claim_wg_tasks(session: AsyncSession, now: datetime, limit: int = 100) -> List[dict]:
+    newer = aliased(WgTask)
+    has_newer = (
+        select(newer.id)
+        .where(newer.config_id == WgTask.config_id, newer.id > WgTask.id)
+        .exists()
+    )
+    await session.execute(
+        update(WgTask)
+        .where(WgTask.status == "pending", has_newer)
+        .values(status="superseded", last_error=None)
+        .execution_options(synchronize_session=False)
+    )
+    result = await session.execute(
+        select(WgTask.id, WgTask.server_id, WgTask.config_id, WgTask.action, WgTask.attempts)
+        .where(
+            WgTask.status == "pending",
+            or_(WgTask.next_attempt_at.is_(None), WgTask.next_attempt_at <= now),
+        )
+        .order_by(WgTask.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return [dict(row._mapping) for row in result]
+
+
+# 43. Записать итог выполнения пачки задач:
+#     done_ids — выполнены;
+#     retry — id → (текст ошибки, время следующей попытки);
+#     failed — id → текст ошибки, попытки исчерпаны.
+async def record_wg_task_results(
+    session: AsyncSession,
+    done_ids: List[int],
+    retry: Dict[int, Tuple[str, datetime]],
+    failed: Dict[int, str],
+) -> None:
+    attempted = [*done_ids, *retry, *failed]
+    if not attempted:
+        return
+    values = {"attempts": WgTask.attempts + 1}
+    if retry or failed:
+        errors = {task_id: error for task_id, (error, _) in retry.items()}
+        errors.update(failed)
+        values["last_error"] = case(errors, value=WgTask.id, else_=None)
+        statuses = {task_id: "pending" for task_id in retry}
+        statuses.update({task_id: "failed" for task_id in failed})
+        values["status"] = case(statuses, value=WgTask.id, else_=literal("done"))
+        if retry:
+            values["next_attempt_at"] = case(
+                {task_id: next_at for task_id, (_, next_at) in retry.items()},
+                value=WgTask.id,
+                else_=WgTask.next_attempt_at,
+            )
+    else:
+        values.update(status="done", last_error=None)
+    await session.execute(
+        update(WgTask)
+        .where(WgTask.id.in_(attempted))
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+
+
+# 44. Прогресс массового действия: {"pending": n, "done": n, "failed": n, "superseded": n}
+async def get_admin_job_progress(session: AsyncSession, job_id: int) -> Dict[str, int]:
+    result = await session.execute(
+        select(WgTask.status, func.count())
+        .where(WgTask.admin_job_id == job_id)
+        .group_by(WgTask.status)
+    )
+    progress = {"pending": 0, "done": 0, "failed": 0, "superseded": 0}
+    progress.update({task_status: count for task_status, count in result})
+    return progress
+
+
+# 45. Поставить задачу для сервера WireGuard в той же транзакции, что и
+#     изменение пользователя (outbox). Диспетчер узнаёт о ней после commit.
+async def enqueue_wg_task(
+    session: AsyncSession,
+    telegram_id: str,
+    server_id: Optional[int],
+    config_id: str,
+    action: str,
+) -> None:
+    session.add(WgTask(
+        telegram_id=telegram_id,
+        server_id=server_id,
+        config_id=config_id,
+        action=action,
+    ))
+    await session.flush()
+    await session.execute(select(func.pg_notify(WG_TASK_CHANNEL, config_id)))
+
+
+# 46. Платный config_id пользователя прямо из БД (мимо кэша) с блокировкой строки
+#     до конца транзакции session (SELECT ... FOR UPDATE): параллельные задания
+#     одного пользователя выбирают клиента WireGuard по очереди, а не оба сразу.
+async def lock_user_config_id(session: AsyncSession, telegram_id: str) -> Optional[str]:
+    result = await session.execute(
+        select(User.config_id).where(User.telegram_id == str(telegram_id)).with_for_update()
+    )
+    return result.scalar_one_or_none()
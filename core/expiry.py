@@ -0,0 +1,119 @@
+# core/expiry.py
+
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional
+
+import asyncpg
+
+from core.database import EXPIRY_CHANNEL, get_upcoming_expirations, listen
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """
+    Планировщик отключения истёкших конфигов.
+    Держит в памяти min-heap сроков окончания, наступающих до следующей
+    пересинхронизации, и спит до ближайшего из них. Новые сроки приходят
+    через LISTEN/NOTIFY (см. core.database.notify_expiration_change),
+    а полная пересинхронизация раз в resync_interval секунд служит страховкой
+    от потерянных уведомлений и неудачных отключений.
+    """
+
+    def __init__(self, on_expired: Callable[[], Awaitable[None]], resync_interval: int):
+        """
+        :param on_expired: Корутина, отключающая все истёкшие на данный момент конфиги.
+        :param resync_interval: Период полной пересинхронизации с БД (в секундах).
+        """
+        self._on_expired = on_expired
+        self._resync_interval = timedelta(seconds=resync_interval)
+        self._heap: List[datetime] = []
+        self._horizon = datetime.min
+        self._wakeup = asyncio.Event()
+        self._listener: Optional[asyncpg.Connection] = None
+
+    def schedule(self, deadline: datetime) -> None:
+        """
+        Добавляет срок окончания в очередь. Сроки дальше текущего горизонта
+        не храним — их подхватит следующая пересинхронизация.
+        """
+        if deadline > self._horizon:
+            return
+        heapq.heappush(self._heap, deadline)
+        if self._heap[0] == deadline:
+            self._wakeup.set()
+
+    def _on_notify(self, payload: str) -> None:
+        try:
+            self.schedule(datetime.fromisoformat(payload))
+        except ValueError:
+            logger.warning(f"Некорректный срок окончания в уведомлении: {payload!r}")
+
+    async def _ensure_listener(self) -> None:
+        if self._listener is not None and not self._listener.is_closed():
+            return
+        try:
+            self._listener = await listen(EXPIRY_CHANNEL, self._on_notify)
+        except Exception as e:
+            # Без подписки продолжаем работать на одних пересинхронизациях
+            self._listener = None
+            logger.error(f"Не удалось подписаться на {EXPIRY_CHANNEL}: {e}")
+
+    async def resync(self) -> None:
+        """
+        Перечитывает из БД все сроки до нового горизонта (включая уже прошедшие,
+        но ещё не отключённые) и пересобирает heap.
+        """
+        await self._ensure_listener()
+        previous = self._horizon
+        # Горизонт сдвигаем до запроса, чтобы уведомления, пришедшие во время
+        # него, попали в heap, а не потерялись
+        self._horizon = datetime.utcnow() + self._resync_interval
+        try:
+            deadlines = await get_upcoming_expirations(self._horizon)
+        except Exception:
+            self._horizon = previous
+            raise
+        # Слияние двух отсортированных списков — тоже корректная куча
+        self._heap = list(heapq.merge(deadlines, sorted(self._heap)))
+
+    async def _sleep_until(self, moment: datetime) -> None:
+        timeout = (moment - datetime.utcnow()).total_seconds()
+        if timeout <= 0:
+            return
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self) -> None:
+        try:
+            while True:
+                now = datetime.utcnow()
+                if now >= self._horizon:
+                    try:
+                        await self.resync()
+                    except Exception as e:
+                        logger.error(f"Ошибка пересинхронизации планировщика отключений: {e}")
+                        await asyncio.sleep(60)
+                    continue
+
+                if self._heap and self._heap[0] <= now:
+                    # Одним проходом отключаем всё, что уже истекло
+                    while self._heap and self._heap[0] <= now:
+                        heapq.heappop(self._heap)
+                    try:
+                        await self._on_expired()
+                    except Exception as e:
+                        logger.error(f"Ошибка при отключении истёкших конфигов: {e}")
+                    continue
+
+                wake_at = min(self._heap[0], self._horizon) if self._heap else self._horizon
+                await self._sleep_until(wake_at)
+        finally:
+            if self._listener is not None and not self._listener.is_closed():
+                await self._listener.close()
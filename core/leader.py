@@ -0,0 +1,87 @@
+# core/leader.py
+
+import asyncio
+import logging
+from typing import Callable, Coroutine, List
+
+import asyncpg
+
+from core.database import connect_raw
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElection:
+    """
+    Выбор лидера среди реплик бота на advisory-блокировке Postgres.
+    Фоновые задачи выполняет только реплика, которая держит блокировку
+    pg_try_advisory_lock(key) на своём отдельном соединении. Блокировка живёт
+    столько же, сколько соединение: если лидер упал или завис и перестал
+    пинговать БД, сервер закрывает его сессию (idle_session_timeout и TCP
+    keepalive), и одна из остальных реплик захватывает блокировку при
+    следующей попытке — через несколько секунд.
+    """
+
+    def __init__(
+        self,
+        key: int,
+        jobs: Callable[[], List[Coroutine]],
+        retry_interval: float,
+    ):
+        """
+        :param key: Ключ advisory-блокировки (общий для всех реплик).
+        :param jobs: Фабрика корутин фоновых задач — вызывается при каждом избрании.
+        :param retry_interval: Период попыток захвата и проверки соединения (в секундах).
+        """
+        self._key = key
+        self._jobs = jobs
+        self._retry_interval = retry_interval
+
+    async def _connect(self) -> asyncpg.Connection:
+        conn = await connect_raw()
+        timeout_ms = int(self._retry_interval * 3 * 1000)
+        try:
+            # Сервер сам обрывает сессию лидера, который перестал пинговать БД
+            await conn.execute(f"SET idle_session_timeout = {timeout_ms}")
+            await conn.execute("SET tcp_keepalives_idle = 5")
+            await conn.execute("SET tcp_keepalives_interval = 2")
+            await conn.execute("SET tcp_keepalives_count = 3")
+        except asyncpg.PostgresError as e:
+            logger.warning(f"Не удалось настроить таймауты соединения лидера: {e}")
+        return conn
+
+    async def _lead(self, conn: asyncpg.Connection) -> None:
+        logger.info("Реплика стала лидером, запускаем фоновые задачи")
+        tasks = [asyncio.create_task(job) for job in self._jobs()]
+        try:
+            while True:
+                await asyncio.sleep(self._retry_interval)
+                # Соединение живо — значит, блокировка всё ещё наша
+                await asyncio.wait_for(conn.fetchval("SELECT 1"), timeout=self._retry_interval)
+                for task in tasks:
+                    if task.done():
+                        raise RuntimeError(f"Фоновая задача завершилась: {task!r}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.info("Реплика больше не лидер, фоновые задачи остановлены")
+
+    async def run(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = await self._connect()
+                while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", self._key):
+                    await asyncio.sleep(self._retry_interval)
+                await self._lead(conn)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка выбора лидера: {e}")
+            finally:
+                # Закрытие соединения освобождает блокировку; terminate не ждёт
+                # ответа сервера, который мог уже пропасть
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            await asyncio.sleep(self._retry_interval)
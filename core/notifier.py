@@ -0,0 +1,110 @@
+# core/notifier.py
+
+import asyncio
+import logging
+import time
+from typing import Dict
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+
+from config import NOTIFY_GLOBAL_RATE, NOTIFY_PER_CHAT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Классическое «ведро токенов»: rate токенов в секунду, не больше capacity в запасе.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Notifier:
+    """
+    Отправка сообщений в темпе, который допускает Telegram: общее ведро на
+    NOTIFY_GLOBAL_RATE сообщений в секунду и не чаще одного сообщения в
+    NOTIFY_PER_CHAT_INTERVAL секунд в один чат. На TelegramRetryAfter
+    приостанавливает все отправки на указанное время и повторяет сообщение.
+    """
+
+    def __init__(self, global_rate: float, per_chat_interval: float, max_retry_after: int = 5):
+        """
+        :param global_rate: Сообщений в секунду на весь процесс.
+        :param per_chat_interval: Минимальный интервал между сообщениями в один чат (в секундах).
+        :param max_retry_after: Сколько раз подряд повторять сообщение после RetryAfter.
+        """
+        self._bucket = TokenBucket(global_rate, global_rate)
+        self._per_chat_interval = per_chat_interval
+        self._max_retry_after = max_retry_after
+        self._chat_next: Dict[int, float] = {}
+        self._paused_until = 0.0
+
+    async def _wait_turn(self, chat_id: int) -> None:
+        # Слот в чате резервируется до ожидания: параллельные отправки в один
+        # чат встают друг за другом, а не просыпаются одновременно
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self._per_chat_interval
+        if len(self._chat_next) > 10000:
+            # Чаты, в которые уже можно писать, больше не нужно помнить
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            await self._bucket.acquire()
+            # Пока ждали токен, другая отправка могла получить RetryAfter —
+            # тогда ждём окончания паузы и берём токен заново
+            if self._paused_until <= time.monotonic():
+                return
+
+    async def send(self, bot: Bot, chat_id: int, text: str, **kwargs) -> bool:
+        """
+        Отправляет сообщение.
+        :return: True — доставлено; False — доставить невозможно (бот заблокирован,
+                 чат не найден), повторять бессмысленно.
+        Прочие ошибки (сеть, 5xx, слишком много RetryAfter подряд) пробрасываются —
+        такое сообщение нужно повторить позже.
+        """
+        for _ in range(self._max_retry_after):
+            await self._wait_turn(chat_id)
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return True
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood limit Telegram: пауза {e.retry_after} с")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                logger.info(f"Сообщение в чат {chat_id} не доставить: {e}")
+                return False
+        raise RuntimeError(f"Слишком много RetryAfter подряд для чата {chat_id}")
+
+
+# Экземпляр для использования (общий темп на весь процесс)
+notifier = Notifier(global_rate=NOTIFY_GLOBAL_RATE, per_chat_interval=NOTIFY_PER_CHAT_INTERVAL)
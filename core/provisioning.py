@@ -0,0 +1,164 @@
+# core/provisioning.py
+
+import logging
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from session import APIResponse
+from core.database import add_server_peers, assign_user_server
+from core.servers import get_api
+
+logger = logging.getLogger(__name__)
+
+
+class ProvisioningError(Exception):
+    """Ошибка при работе с клиентами WireGuard через API."""
+
+
+# Локальный индекс клиентов wg-easy по серверам:
+# server_id → {id → {"name": ..., "createdAt": ...}}.
+# Пополняется по ответам на создание и при каждом чтении полного списка.
+_clients: Dict[int, Dict[str, dict]] = {}
+
+
+def _id_from_response(resp: APIResponse) -> Optional[str]:
+    # Часть версий wg-easy возвращает созданного клиента, часть — только {"success": true}
+    try:
+        data = resp.json()
+    except ValueError:
+        return None
+    if isinstance(data, dict):
+        client_id = data.get("id") or data.get("clientId")
+        if client_id:
+            return str(client_id)
+    return None
+
+
+async def place_user(session: AsyncSession, telegram_id) -> int:
+    """
+    Сервер пользователя (при первом обращении — наименее загруженный из
+    включённых, см. core.database.assign_user_server) в транзакции session.
+    """
+    server_id = await assign_user_server(session, telegram_id)
+    if server_id is None:
+        raise ProvisioningError("Нет серверов WireGuard со свободными местами")
+    return server_id
+
+
+async def list_clients(server_id: int) -> List[dict]:
+    """
+    Полный список клиентов сервера одним запросом — в том виде, в каком его
+    отдаёт wg-easy (id, name, enabled, createdAt, ...).
+    """
+    api = await get_api(server_id)
+    resp = await api.request(method="GET", endpoint="wireguard/client/")
+    if resp.status_code != 200:
+        raise ProvisioningError(f"API list error: {resp.text}")
+    return resp.json()
+
+
+async def refresh_clients(server_id: int) -> Dict[str, dict]:
+    """
+    Читает полный список клиентов сервера и добавляет новые записи в индекс.
+    """
+    clients = _clients.setdefault(server_id, {})
+    for c in await list_clients(server_id):
+        clients[c["id"]] = {"name": c.get("name"), "createdAt": c.get("createdAt")}
+    return clients
+
+
+async def create_client(server_id: int, name: str) -> str:
+    """
+    Создаёт клиента WireGuard с именем name на сервере server_id и возвращает его id.
+    Id берётся из ответа на создание; полный список клиентов читается,
+    только если сервер id не вернул.
+    """
+    known: Set[str] = set(_clients.get(server_id, {}))
+    api = await get_api(server_id)
+    resp = await api.request(
+        method="POST",
+        endpoint="wireguard/client/",
+        json={"name": name}
+    )
+    if resp.status_code != 200:
+        raise ProvisioningError(f"API create error: {resp.text}")
+    await add_server_peers(server_id)
+
+    client_id = _id_from_response(resp)
+    if client_id:
+        _clients.setdefault(server_id, {})[client_id] = {"name": name, "createdAt": None}
+        return client_id
+
+    # Запасной путь: ищем клиента с этим именем, которого ещё не было в индексе
+    # (если таких несколько — самого свежего)
+    clients = await refresh_clients(server_id)
+    candidates = [
+        (entry.get("createdAt") or "", cid)
+        for cid, entry in clients.items()
+        if entry["name"] == name and cid not in known
+    ]
+    if not candidates:
+        raise ProvisioningError(f"Созданный клиент {name} не найден в списке")
+    return max(candidates)[1]
+
+
+async def get_configuration(server_id: int, config_id: str) -> bytes:
+    """
+    Скачивает .conf-файл клиента.
+    """
+    api = await get_api(server_id)
+    resp = await api.request(
+        method="GET",
+        endpoint=f"wireguard/client/{config_id}/configuration"
+    )
+    if resp.status_code != 200:
+        raise ProvisioningError(f"API config file error: {resp.text}")
+    return resp.content
+
+
+async def enable_client(server_id: int, config_id: str) -> None:
+    """
+    Включает клиента WireGuard (например, отключённого по истечении срока).
+    """
+    api = await get_api(server_id)
+    resp = await api.request(
+        method="POST",
+        endpoint=f"wireguard/client/{config_id}/enable",
+        # Включение/отключение можно безопасно повторить
+        idempotent=True,
+    )
+    if resp.status_code >= 400:
+        raise ProvisioningError(f"API enable error: {resp.text}")
+
+
+async def disable_client(server_id: int, config_id: str) -> None:
+    """
+    Отключает клиента WireGuard. Если клиента на сервере уже нет (404) —
+    отключать нечего, это не ошибка.
+    """
+    api = await get_api(server_id)
+    resp = await api.request(
+        method="POST",
+        endpoint=f"wireguard/client/{config_id}/disable",
+        # Включение/отключение можно безопасно повторить
+        idempotent=True,
+    )
+    if resp.status_code >= 400 and resp.status_code != 404:
+        raise ProvisioningError(f"API disable error: {resp.text}")
+
+
+async def rename_client(server_id: int, config_id: str, name: str) -> None:
+    """
+    Переименовывает клиента WireGuard (клиенты тёплого пула получают имя владельца).
+    """
+    api = await get_api(server_id)
+    resp = await api.request(
+        method="PUT",
+        endpoint=f"wireguard/client/{config_id}/name",
+        json={"name": name}
+    )
+    if resp.status_code >= 400:
+        raise ProvisioningError(f"API rename error: {resp.text}")
+    if config_id in _clients.get(server_id, {}):
+        _clients[server_id][config_id]["name"] = name
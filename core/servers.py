@@ -0,0 +1,46 @@
+# core/servers.py
+
+import asyncio
+import logging
+from typing import Dict
+
+from config import WG_API_CONCURRENCY
+from session import APISession
+from core.database import get_server
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownServerError(Exception):
+    """Сервер WireGuard не найден в таблице servers."""
+
+
+# servers.id → сессия к API wg-easy этого сервера (создаётся при первом обращении)
+_sessions: Dict[int, APISession] = {}
+
+# Общий для всех фоновых задач процесса предел одновременных запросов к API
+# WireGuard (WG_API_CONCURRENCY): вместе они не занимают больше половины
+# очереди APISession, и запросы пользователей не отклоняются по WG_API_QUEUE_TIMEOUT
+background_slots = asyncio.Semaphore(WG_API_CONCURRENCY)
+
+
+async def get_api(server_id: int) -> APISession:
+    """
+    Сессия к API сервера server_id. Адрес и пароль берутся из таблицы servers
+    один раз; у каждого сервера свой пул соединений и своя авторизация.
+    """
+    api = _sessions.get(server_id)
+    if api is None:
+        server = await get_server(server_id)
+        if server is None:
+            raise UnknownServerError(f"Сервер {server_id} не найден")
+        api = _sessions.setdefault(
+            server_id, APISession(base_url=server["api_url"], password=server["api_password"])
+        )
+    return api
+
+
+async def close_all() -> None:
+    for api in _sessions.values():
+        await api.close()
+    _sessions.clear()
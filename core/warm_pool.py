@@ -0,0 +1,121 @@
+# core/warm_pool.py
+
+import asyncio
+import logging
+import math
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional, Set
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import (
+    WARM_POOL_MIN,
+    WARM_POOL_MAX,
+    WARM_POOL_WINDOW_SECONDS,
+    WARM_POOL_HEADROOM_SECONDS,
+    WARM_POOL_INTERVAL_SECONDS,
+)
+from core import config_cache
+from core.database import (
+    add_warm_client,
+    claim_warm_client,
+    get_warm_pool_stats,
+    list_servers,
+    purge_claimed_warm_clients,
+)
+from core.provisioning import create_client, get_configuration, rename_client
+from core.servers import background_slots
+
+logger = logging.getLogger(__name__)
+
+# Фоновые переименования, чтобы задачи не собрал сборщик мусора
+_rename_tasks: Set[asyncio.Task] = set()
+
+
+async def _rename_quietly(server_id: int, config_id: str, name: str) -> None:
+    try:
+        await rename_client(server_id, config_id, name)
+    except Exception as e:
+        # Имя нужно только для удобства в веб-интерфейсе wg-easy
+        logger.warning(f"Не удалось переименовать клиента {config_id} в {name}: {e}")
+
+
+async def claim(session: AsyncSession, server_id: int, name: str) -> Optional[str]:
+    """
+    Забирает готового клиента сервера server_id из тёплого пула в транзакции session и
+    возвращает его id (или None, если пул пуст). .conf клиента сразу
+    кладётся в core.config_cache, а переименование в name идёт в фоне —
+    пользователь не ждёт ни одного запроса к API WireGuard.
+    """
+    warm = await claim_warm_client(session, server_id)
+    if warm is None:
+        return None
+    config_cache.put(warm["config_id"], warm["config"])
+    task = asyncio.create_task(_rename_quietly(server_id, warm["config_id"], name))
+    _rename_tasks.add(task)
+    task.add_done_callback(_rename_tasks.discard)
+    return warm["config_id"]
+
+
+async def claim_or_create(session: AsyncSession, server_id: int, name: str) -> str:
+    """
+    Клиент сервера server_id из тёплого пула, а если пул пуст — новый,
+    созданный через API. Может бросить core.provisioning.ProvisioningError.
+    """
+    config_id = await claim(session, server_id, name)
+    if config_id is None:
+        logger.info(f"Тёплый пул сервера {server_id} пуст, создаём клиента через API")
+        config_id = await create_client(server_id, name)
+    return config_id
+
+
+def _target_size(claimed_recently: int) -> int:
+    # Спрос за окно, пересчитанный на запас времени вперёд
+    demand = math.ceil(claimed_recently * WARM_POOL_HEADROOM_SECONDS / WARM_POOL_WINDOW_SECONDS)
+    return max(WARM_POOL_MIN, min(WARM_POOL_MAX, demand))
+
+
+async def _add_one(server_id: int) -> None:
+    async with background_slots:
+        try:
+            config_id = await create_client(server_id, f"pool-{uuid.uuid4().hex[:8]}")
+            config = await get_configuration(server_id, config_id)
+            await add_warm_client(server_id, config_id, config)
+        except Exception as e:
+            logger.warning(f"Не удалось добавить клиента в тёплый пул сервера {server_id}: {e}")
+
+
+async def refill() -> None:
+    """
+    Дополняет тёплый пул каждого включённого сервера до размера,
+    рассчитанного по недавнему спросу на этом сервере.
+    """
+    now = datetime.utcnow()
+    stats = await get_warm_pool_stats(now - timedelta(seconds=WARM_POOL_WINDOW_SECONDS))
+    tasks = []
+    for server in await list_servers(enabled_only=True):
+        free, claimed = stats.get(server["id"], (0, 0))
+        # Не создаём клиентов сверх ёмкости сервера (peer_count уже включает свободных из пула)
+        room = server["capacity"] - server["peer_count"]
+        missing = min(_target_size(claimed) - free, room)
+        if missing > 0:
+            logger.info(
+                f"Тёплый пул сервера {server['name']}: свободно {free}, "
+                f"выдано за окно {claimed}, создаём {missing}"
+            )
+            tasks += [_add_one(server["id"]) for _ in range(missing)]
+    await asyncio.gather(*tasks)
+    await purge_claimed_warm_clients(now - timedelta(seconds=WARM_POOL_WINDOW_SECONDS))
+
+
+async def run_warm_pool() -> None:
+    """
+    Фоновая задача (на реплике-лидере) — раз в WARM_POOL_INTERVAL_SECONDS пополняет пул.
+    """
+    while True:
+        try:
+            await refill()
+        except Exception as e:
+            logger.error(f"Ошибка при пополнении тёплого пула: {e}")
+        await asyncio.sleep(WARM_POOL_INTERVAL_SECONDS)
@@ -1,70 +1,203 @@
 # handlers/auto_disable.py
 
 import asyncio
-from datetime import datetime
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Set
 
 from aiogram import Bot
 
-from session import api_session
-from core.database import get_all_users, disable_config, mark_as_notified
+from config import (
+    EXPIRY_BATCH_SIZE,
+    EXPIRY_RESYNC_SECONDS,
+    EXPIRY_WORKERS,
+    NOTIFY_RETRY_SECONDS,
+)
+from core import config_cache
+from core.database import (
+    AsyncSessionLocal,
+    claim_expired_configs,
+    claim_pending_notices,
+    mark_configs_disabled,
+    record_notice_results,
+)
+from core.expiry import ExpiryScheduler
+from core.provisioning import ProvisioningError, disable_client
+from core.servers import background_slots
+from core.notifier import notifier
+
+logger = logging.getLogger(__name__)
+
+# Максимальная пауза между попытками отправить уведомление (в секундах)
+NOTICE_MAX_BACKOFF = 3600
+
+# Об окончании пробного пишем, только если он истёк не раньше этого срока назад:
+# пробные, выданные до появления trial_status, отключаются без сообщений
+TRIAL_NOTICE_MAX_AGE = timedelta(hours=24)
+
+PAID_EXPIRED_TEXT = (
+    "⚠️ Срок действия вашего платного конфига истёк, он был отключён.\n"
+    "Чтобы восстановить доступ, продлите подписку через главное меню."
+)
+TRIAL_EXPIRED_TEXT = (
+    "⚠️ Срок действия пробного конфига истёк, он был отключён.\n"
+    "Чтобы продолжить пользоваться VPN, оформите подписку через главное меню."
+)
+
+
+def _shares_paid_config(u: dict) -> bool:
+    # Пробный и платный могут указывать на один и тот же клиент WireGuard
+    return u["config_id"] == u["paid_config_id"] and u["paid_status"] == "active"
+
+
+async def _disable_one(u: dict, trial: bool) -> bool:
+    """
+    Отключает один конфиг через API. Возвращает, отключён ли конфиг.
+    """
+    tg_id_str = u["telegram_id"]
+    config_id = u["config_id"]
+
+    # Оплаченный доступ не трогаем, а пробный просто помечаем отключённым
+    if trial and _shares_paid_config(u):
+        return True
+
+    try:
+        async with background_slots:
+            # Отключаем конфиг через API его сервера
+            await disable_client(u["server_id"], config_id)
+    except ProvisioningError as e:
+        logger.warning(f"API disable error для конфига {config_id}: {e}")
+        return False
+    except Exception as e:
+        logger.warning(f"Ошибка при отключении конфига {config_id} для пользователя {tg_id_str}: {e}")
+        return False
+
+    # Отключённый конфиг больше не должен отдаваться из кэша
+    config_cache.invalidate(config_id)
+    return True
+
+
+async def _notify_trial_expired(bot: Bot, tg_id_str: str) -> None:
+    try:
+        await notifier.send(bot, int(tg_id_str), TRIAL_EXPIRED_TEXT)
+    except Exception as e:
+        logger.warning(f"Не удалось уведомить пользователя {tg_id_str}: {e}")
+
+
+async def _expiry_worker(bot: Bot, now: datetime, trial: bool, failed_ids: Set[int]):
+    """
+    Один обработчик: в цикле захватывает пачку (FOR UPDATE SKIP LOCKED),
+    отключает её и записывает статусы одним UPDATE в той же транзакции.
+    """
+    while True:
+        async with AsyncSessionLocal() as session:
+            batch = await claim_expired_configs(
+                session, now, limit=EXPIRY_BATCH_SIZE, trial=trial, exclude_ids=failed_ids
+            )
+            if not batch:
+                return
+
+            results = await asyncio.gather(*(_disable_one(u, trial) for u in batch))
+            disabled = [u for u, ok in zip(batch, results) if ok]
+            # Неудачные не захватываем повторно в этом проходе — их подхватит следующий
+            failed_ids.update(u["id"] for u, ok in zip(batch, results) if not ok)
+
+            # Обновляем статусы всей пачки одним запросом; уведомления об отключении
+            # платных конфигов при этом встают в очередь (см. deliver_expiry_notices)
+            await mark_configs_disabled(
+                [u["telegram_id"] for u in disabled], trial=trial, session=session
+            )
+            await session.commit()
+
+        if trial:
+            await asyncio.gather(*(
+                _notify_trial_expired(bot, u["telegram_id"])
+                for u in disabled
+                if not _shares_paid_config(u)
+                and u["expiration_time"] >= now - TRIAL_NOTICE_MAX_AGE
+            ))
+
+        if len(batch) < EXPIRY_BATCH_SIZE:
+            return
+
 
 async def disable_expired_configs(bot: Bot):
     """
-    Проверяет всех пользователей и отключает «active» конфиги, у которых истёк expiration_time.
-    При первом обнаружении отправляет уведомление и помечает пользователя как «notified».
+    Отключает «active» платные и пробные конфиги, у которых истёк срок.
+    EXPIRY_WORKERS обработчиков параллельно захватывают пачки истёкших
+    конфигов (по индексу, FOR UPDATE SKIP LOCKED — безопасно и между репликами);
+    одновременных запросов к API не больше WG_API_CONCURRENCY.
+    После прохода рассылает накопившиеся уведомления.
     """
     now = datetime.utcnow()
-    users = await get_all_users()
-
-    for u in users:
-        tg_id_str = u["telegram_id"]
-        config_id = u.get("config_id")
-        exp_time = u.get("expiration_time")
-        status = u.get("config_status")
-        notified = u.get("notified", False)
-
-        # Пропускаем, если нет платного конфига или он не активен
-        if not config_id or status != "active" or not exp_time:
-            continue
-
-        # exp_time сейчас уже datetime, но если вдруг строка — пытаемся распарсить
-        if isinstance(exp_time, str):
-            try:
-                exp_time = datetime.fromisoformat(exp_time)
-            except ValueError:
-                # Некорректный формат, пропускаем
-                continue
-
-        # Если время прошло — отключаем
-        if now > exp_time:
-            try:
-                # Отключаем конфиг через внешний API
-                api_session.request(
-                    method="POST",
-                    endpoint=f"wireguard/client/{config_id}/disable"
+    for trial in (False, True):
+        failed_ids: Set[int] = set()
+        await asyncio.gather(
+            *(_expiry_worker(bot, now, trial, failed_ids) for _ in range(EXPIRY_WORKERS))
+        )
+    await deliver_expiry_notices(bot)
+
+
+async def _send_notice(bot: Bot, tg_id_str: str) -> Optional[bool]:
+    """
+    True — доставлено, False — доставить невозможно, None — повторить позже.
+    """
+    try:
+        return await notifier.send(bot, int(tg_id_str), PAID_EXPIRED_TEXT)
+    except Exception as e:
+        logger.warning(f"Не удалось уведомить пользователя {tg_id_str}, повторим позже: {e}")
+        return None
+
+
+async def deliver_expiry_notices(bot: Bot):
+    """
+    Рассылает уведомления об отключении платных конфигов из очереди в БД
+    (notified = false). Темп задаёт core.notifier (лимиты Telegram); то, что
+    не удалось отправить, остаётся в очереди с экспоненциальной паузой
+    до следующей попытки — уведомления не теряются.
+    """
+    while True:
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as session:
+            batch = await claim_pending_notices(session, now, limit=EXPIRY_BATCH_SIZE)
+            if not batch:
+                return
+
+            results = await asyncio.gather(*(_send_notice(bot, u["telegram_id"]) for u in batch))
+            done_ids = [u["telegram_id"] for u, res in zip(batch, results) if res is not None]
+            retry_at = {
+                u["telegram_id"]: now + timedelta(
+                    seconds=min(NOTICE_MAX_BACKOFF, NOTIFY_RETRY_SECONDS * 2 ** u["notify_attempts"])
                 )
-                # Обновляем статус в БД
-                await disable_config(int(tg_id_str))
+                for u, res in zip(batch, results) if res is None
+            }
+            await record_notice_results(session, done_ids, retry_at)
+            await session.commit()
 
-                # Если ещё не уведомляли — отправляем сообщение и помечаем «notified = True»
-                if not notified:
-                    await bot.send_message(
-                        chat_id=int(tg_id_str),
-                        text=(
-                            "⚠️ Срок действия вашего платного конфига истёк, он был отключён.\n"
-                            "Чтобы восстановить доступ, продлите подписку через главное меню."
-                        )
-                    )
-                    await mark_as_notified(int(tg_id_str))
+        if len(batch) < EXPIRY_BATCH_SIZE:
+            return
 
-            except Exception as e:
-                print(f"Ошибка при отключении конфига {config_id} для пользователя {tg_id_str}: {e}")
+
+async def schedule_expiry_notices(bot: Bot):
+    """
+    Фоновая задача — раз в NOTIFY_RETRY_SECONDS повторяет уведомления,
+    которые не удалось отправить сразу.
+    """
+    while True:
+        await asyncio.sleep(NOTIFY_RETRY_SECONDS)
+        try:
+            await deliver_expiry_notices(bot)
+        except Exception as e:
+            logger.error(f"Ошибка при рассылке уведомлений об отключении: {e}")
 
 
 async def schedule_disable_configs(bot: Bot):
     """
-    Фоновая задача — каждые 60 минут вызывает disable_expired_configs.
+    Фоновая задача — вызывает disable_expired_configs в момент наступления
+    ближайшего срока окончания (см. core.expiry.ExpiryScheduler).
     """
-    while True:
-        await disable_expired_configs(bot)
-        await asyncio.sleep(60)
+    scheduler = ExpiryScheduler(
+        on_expired=lambda: disable_expired_configs(bot),
+        resync_interval=EXPIRY_RESYNC_SECONDS,
+    )
+    await scheduler.run()
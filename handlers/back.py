@@ -1,24 +1,24 @@
 # handlers/back.py
 
+from typing import Optional
+
 from aiogram import types, Router
-from core.database import get_user
 from keyboards.menu import get_main_menu
 
 router = Router()
 
 
 @router.callback_query(lambda c: c.data == "back")
-async def handle_back(callback: types.CallbackQuery):
+async def handle_back(callback: types.CallbackQuery, user: Optional[dict]):
     """
     Обработка нажатия «↩️ Назад» в разделе «Мой профиль»:
-    1) Достаём из БД данные о пользователе (username и статус конфигурации).
+    1) Берём данные о пользователе (username и статус конфигурации),
+       загруженные DbSessionMiddleware.
     2) Формируем текст в точности как при /start (привет + статус).
     3) Редактируем текущее сообщение, заменяя его на главный экран с меню.
     """
-    tg_id = callback.from_user.id
-
-    # 1) Получаем данные пользователя из БД
-    user_data = await get_user(tg_id)
+    # 1) Данные пользователя из БД
+    user_data = user
     if not user_data:
         # Если вдруг его нет — просто отвечаем и ничего не делаем
         await callback.answer()
@@ -1,18 +1,16 @@
 # handlers/my_profile.py
 
+from typing import Optional
+
 from aiogram import types
 from aiogram import Router
 from keyboards.menu import get_profile_menu
-from core.database import get_user
 
 router = Router()
 
 
 @router.callback_query(lambda c: c.data == "my_profile")
-async def handle_my_profile(callback: types.CallbackQuery):
-    tg_id = callback.from_user.id
-    user = await get_user(tg_id)
-
+async def handle_my_profile(callback: types.CallbackQuery, user: Optional[dict]):
     if not user:
         await callback.message.answer("Сначала нажмите /start.")
     else:
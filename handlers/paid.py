@@ -1,8 +1,12 @@
 # handlers/paid.py
 
+from typing import Optional
+
 from aiogram import types, Router
+from sqlalchemy.ext.asyncio import AsyncSession
+
 from handlers.payment import send_invoice
-from core.database import add_user, add_username
+from core.database import register_user
 
 router = Router()
 
@@ -15,15 +19,18 @@ paid_options = {
 
 
 @router.callback_query(lambda c: c.data in paid_options)
-async def handle_paid_config_callback(callback: types.CallbackQuery):
+async def handle_paid_config_callback(
+    callback: types.CallbackQuery,
+    session: AsyncSession,
+    user: Optional[dict],
+):
     tg_id = callback.from_user.id
     option_key = callback.data
     months = paid_options[option_key]["months"]
 
     # Обновляем профиль (если нужно)
     username = callback.from_user.username or "Anon"
-    await add_user(tg_id, username)
-    await add_username(tg_id, username)
+    await register_user(tg_id, username, session=session, user=user)
 
     # Редактируем сообщение на «🔄 Формируем счёт…»
     await callback.message.edit_text(
@@ -2,25 +2,17 @@
 
 import json
 import logging
-from datetime import datetime, timedelta
 
 from aiogram import Router, types
 from aiogram.types import (
     LabeledPrice,
     PreCheckoutQuery,
     SuccessfulPayment,
-    BufferedInputFile,
 )
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from config import PAYMENT_PROVIDER_TOKEN
-from session import api_session
-from keyboards.menu import get_main_menu, get_config_menu
-from core.database import (
-    save_config_id,
-    set_expiration_time,
-    enable_config,
-    get_user,
-)
+from core.database import enqueue_provisioning_job, record_payment
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -46,7 +38,7 @@ async def handle_paid_config_callback(callback: types.CallbackQuery):
     months = int(option_key.split("_")[-1])
 
     # На этом этапе мы могли бы обновить/создать запись в БД о пользователе
-    # (add_user, add_username), если это необходимо.
+    # (register_user), если это необходимо.
 
     payload = f"{tg_id}:{option_key}"
     await send_invoice(callback, payload)
@@ -126,18 +118,15 @@ async def process_pre_checkout(pre_checkout_q: PreCheckoutQuery):
 
 
 @router.message(lambda m: m.successful_payment is not None)
-async def handle_successful_payment(message: types.Message):
+async def handle_successful_payment(message: types.Message, session: AsyncSession):
     """
-    1) Telegram подтвердил оплату (SuccessfulPayment).
-    2) Разбираем payload, проверяем, есть ли у пользователя config_id в БД:
-       • Если config_id нет → создаём нового клиента с именем str(tg_id)
-                            и сохраняем config_id.
-       • Если config_id уже есть → пропускаем создание, используем существующий.
-    3) Скачиваем и отправляем файл .conf (один и тот же) пользователю.
-    4) Продлеваем expiration_time:
-       • Если старый expiration_time ещё в будущем → old + hours.
-       • Иначе → now + hours.
-    5) После отправки .conf кидаем новое сообщение с главным меню.
+    Telegram подтвердил оплату (SuccessfulPayment).
+    Разбираем payload, записываем платёж в журнал (payments) и ставим задание
+    на выдачу конфига в очередь (provisioning_jobs) — в одной транзакции,
+    которая коммитится до ответа пользователю.
+    Сам конфиг создаёт/продлевает и отправляет обработчик очереди
+    (handlers/provision_jobs.py). Повторно доставленный платёж (тот же
+    telegram_payment_charge_id) уже есть в журнале и пропускается.
     """
     payment: SuccessfulPayment = message.successful_payment
     payload = payment.invoice_payload  # "<tg_id>:<option_key>"
@@ -158,99 +147,34 @@ async def handle_successful_payment(message: types.Message):
         await message.answer("❌ Неизвестный тариф.")
         return
 
-    params = paid_options[option_key]
-    hours = params["hours"]
-
-    # 1) Проверяем в БД наличие config_id и expiration_time
-    user = await get_user(tg_id)
-    existing_config_id = None
-    existing_exp_str    = None
-
-    if user:
-        existing_config_id = user.get("config_id")         # config_id или None
-        existing_exp_str    = user.get("expiration_time")  # строка с datetimestamp
-
+    hours = paid_options[option_key]["hours"]
     try:
-        # Если клиента ещё нет, создаём с именем=строка telegram_id
-        if not existing_config_id:
-            create_resp = api_session.request(
-                method="POST",
-                endpoint="wireguard/client/",
-                json={"name": str(tg_id)}
-            )
-            if create_resp.status_code != 200:
-                logger.error(f"API create error: {create_resp.text}")
-                await message.answer("❌ Не удалось создать платный конфиг. Попробуйте позже.")
-                return
-
-            # Получаем список клиентов и находим только что созданного по name=str(tg_id)
-            list_resp = api_session.request(method="GET", endpoint="wireguard/client/")
-            if list_resp.status_code != 200:
-                logger.error(f"API list error: {list_resp.text}")
-                await message.answer("❌ Ошибка при получении списка конфигураций.")
-                return
-
-            configs = list_resp.json()
-            config_entry = next(
-                (c for c in configs if c["name"] == str(tg_id)), None
-            )
-            if not config_entry:
-                await message.answer("❌ Конфигурация не найдена.")
-                return
-
-            paid_config_id = config_entry["id"]
-            # Сохраняем в БД единственный config_id
-            await save_config_id(tg_id, paid_config_id)
-
-        else:
-            # Если config_id уже есть, используем его
-            paid_config_id = existing_config_id
-
-        # 2) Скачиваем и отправляем один и тот же файл .conf
-        file_resp = api_session.request(
-            method="GET",
-            endpoint=f"wireguard/client/{paid_config_id}/configuration"
+        is_new = await record_payment(
+            charge_id=payment.telegram_payment_charge_id,
+            provider_charge_id=payment.provider_payment_charge_id,
+            telegram_id=tg_id,
+            option_key=option_key,
+            amount=payment.total_amount,
+            currency=payment.currency,
+            hours=hours,
+            session=session,
         )
-        if file_resp.status_code != 200:
-            logger.error(f"API config file error: {file_resp.text}")
-            await message.answer("❌ Не удалось получить файл конфигурации.")
+        if not is_new:
+            logger.info(f"Платёж {payment.telegram_payment_charge_id} уже обработан")
             return
 
-        config_file = BufferedInputFile(
-            file=file_resp.content,
-            filename=f"{tg_id}.conf"
+        await enqueue_provisioning_job(
+            charge_id=payment.telegram_payment_charge_id,
+            telegram_id=tg_id,
+            hours=hours,
+            session=session,
         )
-        await message.answer_document(config_file)
-
-        # 3) Рассчитываем новое expiration_time
-        now = datetime.utcnow()
-        if existing_exp_str:
-            try:
-                old_exp = datetime.strptime(existing_exp_str, "%Y-%m-%d %H:%M:%S")
-            except Exception:
-                old_exp = None
-        else:
-            old_exp = None
-
-        if old_exp and old_exp > now:
-            new_exp = old_exp + timedelta(hours=hours)
-        else:
-            new_exp = now + timedelta(hours=hours)
-
-        # Сохраняем время окончания в БД
-        await set_expiration_time(tg_id, new_exp)
-
-        # 4) Отмечаем конфиг как активный (если у вас есть такая логика)
-        await enable_config(tg_id)
-
-        # 5) Отправляем новое сообщение с главным меню
-        await message.answer(
-            f"✅ Ваш платный конфиг активен до *{new_exp.strftime('%Y-%m-%d %H:%M:%S')}* UTC.\n\n"
-            "Выберите следующее действие:",
-            parse_mode="Markdown",
-            reply_markup=get_main_menu()
-        )
-
+        # Подтверждаем оплату только после того, как платёж и задание
+        # записаны в БД, — не дожидаясь commit в middleware
+        await session.commit()
     except Exception as e:
         logger.error(f"Ошибка в handle_successful_payment: {e}")
         await message.answer("⚠️ Внутренняя ошибка при обработке платежа.")
+        raise
+
+    await message.answer("✅ Оплата получена! Готовим ваш конфиг — он придёт следующим сообщением.")
@@ -0,0 +1,154 @@
+# handlers/provision_jobs.py
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+
+from config import (
+    PROVISION_WORKERS,
+    PROVISION_POLL_SECONDS,
+    PROVISION_LEASE_SECONDS,
+    PROVISION_RETRY_SECONDS,
+    PROVISION_MAX_ATTEMPTS,
+)
+from core.config_cache import send_config_to_chat
+from core.database import (
+    PROVISION_CHANNEL,
+    AsyncSessionLocal,
+    apply_provisioning_job,
+    claim_provisioning_job,
+    get_user,
+    listen,
+    lock_user_config_id,
+    save_job_config_id,
+    update_provisioning_job,
+)
+from core.provisioning import enable_client, place_user
+from core.warm_pool import claim_or_create
+from keyboards.menu import get_main_menu
+
+logger = logging.getLogger(__name__)
+
+# Максимальная пауза между попытками выполнить задание (в секундах)
+PROVISION_MAX_BACKOFF = 3600
+
+
+async def _process_job(bot: Bot, job: dict) -> None:
+    """
+    Выполняет задание по шагам. Каждый шаг записывает свой результат в задание,
+    поэтому после сбоя задание продолжается с того места, где остановилось:
+    1) сервер пользователя и клиент WireGuard на нём (существующий config_id,
+       из тёплого пула или новый) — под блокировкой строки пользователя, чтобы
+       два задания одного пользователя не выдали ему двух клиентов;
+    2) продление срока и статус active — одна транзакция с отметкой в задании;
+    3) включение клиента на сервере WireGuard;
+    4) отправка .conf и сообщения пользователю.
+    """
+    tg_id = job["telegram_id"]
+
+    config_id = job["config_id"]
+    if not config_id:
+        async with AsyncSessionLocal() as session:
+            current_config_id = await lock_user_config_id(session, tg_id)
+            server_id = await place_user(session, tg_id)
+            config_id = current_config_id or await claim_or_create(session, server_id, tg_id)
+            await save_job_config_id(job["id"], tg_id, config_id, session=session)
+            await session.commit()
+    else:
+        server_id = (await get_user(int(tg_id)))["server_id"]
+
+    new_exp = await apply_provisioning_job(job["id"])
+
+    if not job["wg_enabled"]:
+        await enable_client(server_id, config_id)
+        await update_provisioning_job(job["id"], wg_enabled=True)
+
+    try:
+        await send_config_to_chat(bot, int(tg_id), server_id, config_id, f"{tg_id}.conf")
+        await bot.send_message(
+            chat_id=int(tg_id),
+            text=(
+                f"✅ Ваш платный конфиг активен до *{new_exp.strftime('%Y-%m-%d %H:%M:%S')}* UTC.\n\n"
+                "Выберите следующее действие:"
+            ),
+            parse_mode="Markdown",
+            reply_markup=get_main_menu(),
+        )
+    except TelegramForbiddenError as e:
+        # Пользователь заблокировал бота — конфиг выдан, доставить его некуда
+        logger.warning(f"Не удалось отправить конфиг пользователю {tg_id}: {e}")
+
+    await update_provisioning_job(job["id"], status="done", last_error=None)
+
+
+async def _handle_failure(bot: Bot, job: dict, error: Exception) -> None:
+    if job["attempts"] >= PROVISION_MAX_ATTEMPTS:
+        logger.error(f"Задание {job['charge_id']} не выполнено после {job['attempts']} попыток: {error}")
+        await update_provisioning_job(job["id"], status="failed", last_error=str(error))
+        try:
+            await bot.send_message(
+                chat_id=int(job["telegram_id"]),
+                text="❌ Не удалось выдать платный конфиг. Обратитесь в поддержку — оплата сохранена.",
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить пользователя {job['telegram_id']}: {e}")
+        return
+
+    delay = min(PROVISION_MAX_BACKOFF, PROVISION_RETRY_SECONDS * 2 ** (job["attempts"] - 1))
+    logger.warning(f"Задание {job['charge_id']}: ошибка, повтор через {delay} с: {error}")
+    await update_provisioning_job(
+        job["id"],
+        next_attempt_at=datetime.utcnow() + timedelta(seconds=delay),
+        last_error=str(error),
+    )
+
+
+async def _worker(bot: Bot, wakeup: asyncio.Event) -> None:
+    while True:
+        try:
+            job = await claim_provisioning_job(datetime.utcnow(), lease=PROVISION_LEASE_SECONDS)
+        except Exception as e:
+            logger.error(f"Ошибка чтения очереди заданий: {e}")
+            job = None
+
+        if job is None:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=PROVISION_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            continue
+
+        try:
+            await _process_job(bot, job)
+        except Exception as e:
+            try:
+                await _handle_failure(bot, job, e)
+            except Exception as db_error:
+                # Задание вернётся в работу по истечении PROVISION_LEASE_SECONDS
+                logger.error(f"Не удалось записать ошибку задания {job['charge_id']}: {db_error}")
+
+
+async def run_provisioning_workers(bot: Bot) -> None:
+    """
+    Фоновая задача (в каждой реплике и каждом процессе): PROVISION_WORKERS
+    обработчиков разбирают очередь provisioning_jobs. Задания захватываются
+    через FOR UPDATE SKIP LOCKED, поэтому обработчики в разных репликах не
+    мешают друг другу. Новые задания будят обработчиков через LISTEN/NOTIFY,
+    а если подписка недоступна — очередь опрашивается раз в PROVISION_POLL_SECONDS.
+    """
+    wakeup = asyncio.Event()
+    conn = None
+    try:
+        conn = await listen(PROVISION_CHANNEL, lambda _payload: wakeup.set())
+    except Exception as e:
+        logger.warning(f"Подписка на {PROVISION_CHANNEL} недоступна, только опрос очереди: {e}")
+
+    try:
+        await asyncio.gather(*(_worker(bot, wakeup) for _ in range(PROVISION_WORKERS)))
+    finally:
+        if conn is not None and not conn.is_closed():
+            await conn.close()
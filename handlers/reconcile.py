@@ -0,0 +1,126 @@
+# handlers/reconcile.py
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List
+
+from config import RECONCILE_INTERVAL_SECONDS
+from core import config_cache
+from core.database import (
+    get_server_config_states,
+    get_warm_config_ids,
+    list_servers,
+    set_server_peer_count,
+)
+from core.provisioning import disable_client, enable_client, list_clients
+from core.servers import background_slots
+
+logger = logging.getLogger(__name__)
+
+
+async def _apply(
+    server_id: int,
+    config_ids: List[str],
+    enable: bool,
+) -> int:
+    """
+    Включает или отключает клиентов не больше чем WG_API_CONCURRENCY запросами
+    одновременно. Возвращает число неудачных запросов.
+    """
+    async def _one(config_id: str) -> bool:
+        async with background_slots:
+            try:
+                if enable:
+                    await enable_client(server_id, config_id)
+                else:
+                    await disable_client(server_id, config_id)
+                    config_cache.invalidate(config_id)
+                return True
+            except Exception as e:
+                action = "включить" if enable else "отключить"
+                logger.warning(f"Сверка: не удалось {action} клиента {config_id}: {e}")
+                return False
+
+    results = await asyncio.gather(*(_one(config_id) for config_id in config_ids))
+    return results.count(False)
+
+
+async def reconcile_server(server: dict) -> Dict[str, int]:
+    """
+    Сверяет один сервер: список клиентов читается одним запросом, снимок из БД —
+    одним запросом по индексу; расхождения ищутся по словарю config_id → состояние
+    за один проход. Возвращает метрики расхождений.
+    """
+    server_id = server["id"]
+    # Сначала список с сервера, потом снимок БД: изменение, попавшее между ними,
+    # в снимке уже есть, и сверка его не откатит
+    peers = await list_clients(server_id)
+    expected = await get_server_config_states(server_id, datetime.utcnow())
+    warm_ids = await get_warm_config_ids(server_id)
+
+    to_enable: List[str] = []
+    to_disable: List[str] = []
+    untracked = 0
+    seen = set()
+    for peer in peers:
+        config_id = peer["id"]
+        seen.add(config_id)
+        should_be_enabled = expected.get(config_id)
+        if should_be_enabled is None:
+            # Чужой клиент (создан вручную или потерян ботом) — не трогаем, только считаем
+            if config_id not in warm_ids:
+                untracked += 1
+            continue
+        is_enabled = bool(peer.get("enabled", True))
+        if should_be_enabled and not is_enabled:
+            to_enable.append(config_id)
+        elif not should_be_enabled and is_enabled:
+            to_disable.append(config_id)
+
+    failed = await _apply(server_id, to_disable, False)
+    failed += await _apply(server_id, to_enable, True)
+
+    await set_server_peer_count(server_id, len(peers))
+
+    return {
+        "peers": len(peers),
+        "tracked": len(expected),
+        "enabled_drift": len(to_enable),
+        "disabled_drift": len(to_disable),
+        "untracked": untracked,
+        # Клиент есть в БД, но его нет на сервере
+        "missing": sum(1 for config_id in expected if config_id not in seen),
+        "failed": failed,
+    }
+
+
+async def reconcile_all() -> None:
+    for server in await list_servers():
+        try:
+            metrics = await reconcile_server(server)
+        except Exception as e:
+            logger.error(f"Сверка сервера {server['name']} не выполнена: {e}")
+            continue
+        level = logging.WARNING if (
+            metrics["enabled_drift"] or metrics["disabled_drift"] or metrics["missing"]
+        ) else logging.INFO
+        logger.log(
+            level,
+            f"Сверка сервера {server['name']}: "
+            + ", ".join(f"{key}={value}" for key, value in metrics.items()),
+        )
+
+
+async def schedule_reconcile():
+    """
+    Фоновая задача (на реплике-лидере) — раз в RECONCILE_INTERVAL_SECONDS
+    сверяет таблицу users со списками клиентов на всех серверах WireGuard и
+    исправляет расхождения (например, после неудачного отключения по сроку).
+    """
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL_SECONDS)
+        try:
+            await reconcile_all()
+        except Exception as e:
+            logger.error(f"Ошибка при сверке с серверами WireGuard: {e}")
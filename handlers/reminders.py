@@ -0,0 +1,81 @@
+# handlers/reminders.py
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Set
+
+from aiogram import Bot
+
+from config import EXPIRY_BATCH_SIZE, REMINDER_OFFSETS_HOURS, REMINDER_INTERVAL_SECONDS
+from core.database import AsyncSessionLocal, claim_due_reminders, mark_reminded
+from core.notifier import notifier
+
+logger = logging.getLogger(__name__)
+
+
+def _reminder_text(expiration_time: datetime) -> str:
+    return (
+        "⏳ Срок действия вашего конфига скоро истечёт: "
+        f"{expiration_time.strftime('%Y-%m-%d %H:%M')} UTC.\n"
+        "Чтобы не потерять доступ, продлите подписку через главное меню."
+    )
+
+
+async def _send_reminder(bot: Bot, u: dict) -> bool:
+    """
+    True — доставлено (или доставить невозможно), False — повторить при следующей проверке.
+    """
+    try:
+        await notifier.send(bot, int(u["telegram_id"]), _reminder_text(u["expiration_time"]))
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось отправить напоминание пользователю {u['telegram_id']}: {e}")
+        return False
+
+
+async def _send_offset_reminders(bot: Bot, now: datetime, offset_hours: int):
+    failed_ids: Set[int] = set()
+    while True:
+        async with AsyncSessionLocal() as session:
+            batch = await claim_due_reminders(
+                session, now, offset_hours, limit=EXPIRY_BATCH_SIZE, exclude_ids=failed_ids
+            )
+            if not batch:
+                return
+
+            results = await asyncio.gather(*(_send_reminder(bot, u) for u in batch))
+            failed_ids.update(u["id"] for u, ok in zip(batch, results) if not ok)
+            await mark_reminded(
+                session,
+                [u["telegram_id"] for u, ok in zip(batch, results) if ok],
+                offset_hours,
+            )
+            await session.commit()
+
+        if len(batch) < EXPIRY_BATCH_SIZE:
+            return
+
+
+async def send_expiry_reminders(bot: Bot):
+    """
+    Рассылает напоминания об окончании подписки за REMINDER_OFFSETS_HOURS часов.
+    Отступы обходятся по возрастанию: пользователь, до конца срока которого
+    меньше суток, получает только напоминание «за сутки», а не все сразу.
+    Каждое напоминание отправляется один раз на каждый срок (users.reminded_hours).
+    """
+    now = datetime.utcnow()
+    for offset_hours in REMINDER_OFFSETS_HOURS:
+        await _send_offset_reminders(bot, now, offset_hours)
+
+
+async def schedule_expiry_reminders(bot: Bot):
+    """
+    Фоновая задача — раз в REMINDER_INTERVAL_SECONDS вызывает send_expiry_reminders.
+    """
+    while True:
+        try:
+            await send_expiry_reminders(bot)
+        except Exception as e:
+            logger.error(f"Ошибка при рассылке напоминаний: {e}")
+        await asyncio.sleep(REMINDER_INTERVAL_SECONDS)
@@ -1,25 +1,26 @@
 # handlers/send_config.py
 
+from typing import Optional
+
 from aiogram import types
 from aiogram import Router
-from aiogram.types import BufferedInputFile
 
-from session import api_session
-from core.database import get_user
+from session import BackendUnavailable
+from core.config_cache import send_config_document
+from core.provisioning import ProvisioningError
 
 router = Router()
 
 
 @router.callback_query(lambda c: c.data == "send_config")
-async def handle_send_config(callback: types.CallbackQuery):
+async def handle_send_config(callback: types.CallbackQuery, user: Optional[dict]):
     """
     При нажатии «send_config» бот:
     1. Берёт config_id из БД для данного пользователя.
-    2. Делает запрос к API WireGuard на получение .conf.
-    3. Отправляет файл пользователю.
+    2. Отправляет .conf: повторно — по сохранённому file_id Telegram,
+       без запроса к API WireGuard и без повторной загрузки файла.
     """
     tg_id = callback.from_user.id
-    user = await get_user(tg_id)
 
     # 1. Проверяем, есть ли у пользователя сохранённый config_id
     if not user or not user.get("config_id"):
@@ -30,21 +31,16 @@ async def handle_send_config(callback: types.CallbackQuery):
     config_id = user["config_id"]
 
     try:
-        # 2. Запрашиваем файл конфигурации у API
-        resp = api_session.request(
-            method="GET",
-            endpoint=f"wireguard/client/{config_id}/configuration"
-        )
-        if resp.status_code != 200:
-            await callback.answer("❌ Ошибка при получении файла конфигурации.",show_alert=True)
-            return
-
-        # 3. Формируем BufferedInputFile и отправляем
-        config_file = BufferedInputFile(
-            file=resp.content,
-            filename=f"{tg_id}_config.conf"
-        )
-        await callback.message.answer_document(config_file)
+        # 2. Отправляем файл (при промахе кэша он скачивается из API)
+        await send_config_document(callback.message, user["server_id"], config_id, f"{tg_id}_config.conf")
+
+    except BackendUnavailable as e:
+        await callback.answer("⏳ Сервер VPN временно недоступен. Попробуйте через пару минут.",show_alert=True)
+        print(e)
+
+    except ProvisioningError as e:
+        await callback.answer("❌ Ошибка при получении файла конфигурации.",show_alert=True)
+        print(e)
 
     except Exception as e:
         # В случае ошибки выводим сообщение
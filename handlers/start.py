@@ -1,17 +1,20 @@
 # handlers/start.py
 
+from typing import Optional
+
 from aiogram import types
 from aiogram.filters import Command
 from aiogram import Router
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from core.database import add_user, add_username, get_user  # ваши асинхронные функции из database.py
+from core.database import register_user  # ваши асинхронные функции из database.py
 from keyboards.menu import get_main_menu
 
 router = Router()
 
 
 @router.message(Command(commands=["start"]))
-async def handle_start(message: types.Message):
+async def handle_start(message: types.Message, session: AsyncSession, user: Optional[dict]):
     """
     При вводе /start:
     1) сохраняем (или обновляем) пользователя в БД;
@@ -20,12 +23,8 @@ async def handle_start(message: types.Message):
     telegram_id = message.from_user.id
     username = message.from_user.username or "Anon"
 
-    # 1. Добавляем пользователя, если он новый, или просто получаем существующую запись
-    await add_user(telegram_id, username)
-    await add_username(telegram_id, username)
-
-    # 2. Получаем из БД актуальные данные (если потребуется в дальнейшем)
-    user_data = await get_user(telegram_id)
+    # 1–2. Добавляем пользователя (или обновляем username) и сразу получаем актуальную запись
+    user_data = await register_user(telegram_id, username, session=session, user=user)
 
     # 3. Формируем главное меню
     keyboard = get_main_menu()
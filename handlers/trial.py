@@ -1,49 +1,59 @@
 # handlers/trial.py
 
+from datetime import datetime, timedelta
+from typing import Optional
+
 from aiogram import types
 from aiogram import Router
-from aiogram.types import BufferedInputFile
-from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from session import api_session
+from session import BackendUnavailable
+from core.config_cache import send_config_document
+from core.provisioning import ProvisioningError, place_user
+from core.warm_pool import claim_or_create
 from keyboards.menu import get_main_menu, get_config_menu
-from core.database import (
-    add_user,
-    add_username,
-    has_used_trial,
-    set_trial_used,
-    save_trial_config_id,
-    set_trial_expiration_time,
-    get_user
-)
+from core.database import register_user, save_trial_config_id
 
 router = Router()
 
 
 @router.callback_query(lambda c: c.data == "trial")
-async def handle_trial_callback(callback: types.CallbackQuery):
+async def handle_trial_callback(
+    callback: types.CallbackQuery,
+    session: AsyncSession,
+    user: Optional[dict],
+):
     """
     Хэндлер для кнопки «Тестовый конфиг».
     Логика:
     1. Добавляем/обновляем username в БД.
     2. Проверяем, использовал ли пользователь пробный ранее.
+       - Если пробный ещё действует → отправляем .conf повторно
+         (например, если в прошлый раз отправка не удалась).
        - Если да → показываем алерт и выходим.
-    3. Создаём нового клиента через API.
-    4. Получаем список клиентов, находим только что созданный.
-    5. Сохраняем config_id в БД, запрашиваем сам файл конфига.
+    3. Выбираем сервер пользователя и берём заранее созданного клиента
+       из тёплого пула этого сервера (core/warm_pool.py).
+    4. Если пул пуст — создаём нового клиента через API.
+    5. Сохраняем config_id вместе со сроком окончания (через 24 часа) и
+       отметкой, что пробный использован, — одним UPDATE.
     6. Шлем .conf-файл пользователю.
-    7. Ставим время окончания через 24 часа, помечаем пробный как использованный.
-    8. Редактируем предыдущее сообщение, возвращая главное меню.
+    7. Редактируем предыдущее сообщение, возвращая главное меню.
     """
     tg_id = callback.from_user.id
     username = callback.from_user.username or "Anon"
 
     # 1. Обновляем username и создаём запись, если новая
-    await add_username(tg_id, username)
-    await add_user(tg_id, username)
+    user = await register_user(tg_id, username, session=session, user=user)
 
     # 2. Проверяем, брал ли уже пробный
-    if await has_used_trial(tg_id):
+    trial_expiration = user.get("trial_expiration_time")
+    trial_active = (
+        user.get("trial_status") == "active"
+        and user.get("trial_config_id")
+        and trial_expiration is not None
+        and trial_expiration > datetime.utcnow()
+    )
+    if user.get("trial_used") and not trial_active:
         await callback.answer(
             "⚠️ Вы уже использовали тестовую конфигурацию (доступна только один раз).",
             show_alert=True
@@ -51,67 +61,50 @@ async def handle_trial_callback(callback: types.CallbackQuery):
         return
 
     try:
-        # 3. Создаём пробного клиента через API
-        create_resp = api_session.request(
-            method="POST",
-            endpoint="wireguard/client/",
-            json={"name": str(tg_id)}
-        )
-        if create_resp.status_code != 200:
+        if trial_active:
+            server_id = user["server_id"]
+            trial_config_id = user["trial_config_id"]
+            expiration_time = trial_expiration
+        else:
+            # 3–4. Берём готового клиента из тёплого пула (или создаём через API, если пул пуст)
+            try:
+                server_id = await place_user(session, tg_id)
+                trial_config_id = await claim_or_create(session, server_id, str(tg_id))
+            except BackendUnavailable as e:
+                await callback.answer(
+                    "⏳ Сервер VPN временно недоступен. Попробуйте через пару минут.", show_alert=True
+                )
+                print(e)
+                return
+            except ProvisioningError as e:
+                await callback.answer(
+                    "❌ Ошибка при создании пробного конфига. Попробуйте позже.", show_alert=True
+                )
+                print(e)
+                return
+
+            # 5. Сохраняем config_id сразу со сроком окончания: если отправка
+            #    ниже не удастся, конфиг всё равно отключится по сроку
+            expiration_time = datetime.utcnow() + timedelta(hours=24)
+            await save_trial_config_id(tg_id, trial_config_id, expiration_time, session=session)
+
+        # 6. Отправляем файл конфигурации (через кэш .conf и file_id)
+        try:
+            await send_config_document(callback.message, server_id, trial_config_id, f"{tg_id}.conf")
+        except BackendUnavailable as e:
             await callback.answer(
-                "❌ Ошибка при создании пробного конфига. Попробуйте позже.", show_alert=True
+                "⏳ Сервер VPN временно недоступен. Попробуйте через пару минут.", show_alert=True
             )
-            print("API create error:", create_resp.text)
-            await callback.answer()
+            print(e)
             return
-
-        # 4. Получаем список клиентов, ищем нужный
-        list_resp = api_session.request(method="GET", endpoint="wireguard/client/")
-        if list_resp.status_code != 200:
-            await callback.answer(
-                "❌ Не удалось получить список конфигураций. Попробуйте позже.", show_alert=True
-            )
-            print("API list error:", list_resp.text)
-            await callback.answer()
-            return
-
-        configs = list_resp.json()
-        config_entry = next((c for c in configs if c["name"] == str(tg_id)), None)
-        if not config_entry:
-            await callback.answer("❌ Конфигурация не найдена.", show_alert=True)
-            await callback.answer()
-            return
-
-        trial_config_id = config_entry["id"]
-
-        # 5. Сохраняем config_id в БД
-        await save_trial_config_id(tg_id, trial_config_id)
-
-        # 6. Запрашиваем файл конфигурации и отсылаем его
-        file_resp = api_session.request(
-            method="GET",
-            endpoint=f"wireguard/client/{trial_config_id}/configuration"
-        )
-        if file_resp.status_code != 200:
+        except ProvisioningError as e:
             await callback.answer(
                 "❌ Ошибка при получении файла конфигурации.", show_alert=True
             )
-            print("API config file error:", file_resp.text)
-            await callback.answer()
+            print(e)
             return
 
-        config_file = BufferedInputFile(
-            file=file_resp.content,
-            filename=f"{tg_id}.conf"
-        )
-        await callback.message.answer_document(config_file)
-
-        # 7. Устанавливаем время окончания и помечаем пробный как использованный
-        expiration_time = datetime.utcnow() + timedelta(hours=24)
-        await set_trial_expiration_time(tg_id, expiration_time)
-        await set_trial_used(tg_id, used=True)
-
-        # 8. Редактируем предыдущее сообщение: возвращаем главное меню
+        # 7. Редактируем предыдущее сообщение: возвращаем главное меню
         await callback.message.edit_text(
             f"✅ Ваш пробный конфиг будет действовать до "
             f"{expiration_time.strftime('%Y-%m-%d %H:%M:%S')} UTC.\n\n"
@@ -0,0 +1,117 @@
+# handlers/wg_tasks.py
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+from config import (
+    WG_TASK_BATCH_SIZE,
+    WG_TASK_POLL_SECONDS,
+    WG_TASK_RETRY_SECONDS,
+    WG_TASK_MAX_ATTEMPTS,
+)
+from core import config_cache
+from core.database import (
+    WG_TASK_CHANNEL,
+    AsyncSessionLocal,
+    claim_wg_tasks,
+    listen,
+    record_wg_task_results,
+)
+from core.provisioning import disable_client, enable_client
+from core.servers import background_slots
+
+logger = logging.getLogger(__name__)
+
+# Максимальная пауза между попытками выполнить задачу (в секундах)
+WG_TASK_MAX_BACKOFF = 3600
+
+
+async def _run_task(task: dict) -> None:
+    async with background_slots:
+        if task["action"] == "enable":
+            await enable_client(task["server_id"], task["config_id"])
+        else:
+            await disable_client(task["server_id"], task["config_id"])
+            config_cache.invalidate(task["config_id"])
+
+
+async def process_wg_tasks_batch() -> int:
+    """
+    Захватывает до WG_TASK_BATCH_SIZE задач и выполняет их не больше чем
+    WG_API_CONCURRENCY запросами одновременно. Строки задач заблокированы до
+    записи результата, поэтому одна задача не выполняется дважды. Неудачная
+    задача повторяется с экспоненциальной паузой, после WG_TASK_MAX_ATTEMPTS
+    попыток помечается failed (расхождение потом исправит сверка).
+    Возвращает число захваченных задач.
+    """
+    async with AsyncSessionLocal() as session:
+        now = datetime.utcnow()
+        tasks = await claim_wg_tasks(session, now, limit=WG_TASK_BATCH_SIZE)
+        if not tasks:
+            return 0
+
+        results = await asyncio.gather(
+            *(_run_task(task) for task in tasks), return_exceptions=True
+        )
+        done_ids: List[int] = []
+        retry: Dict[int, Tuple[str, datetime]] = {}
+        failed: Dict[int, str] = {}
+        for task, result in zip(tasks, results):
+            if not isinstance(result, Exception):
+                done_ids.append(task["id"])
+                continue
+            error = str(result) or type(result).__name__
+            attempts = task["attempts"] + 1
+            if attempts >= WG_TASK_MAX_ATTEMPTS:
+                logger.error(
+                    f"Задача {task['id']} ({task['action']} {task['config_id']}) "
+                    f"не выполнена после {attempts} попыток: {error}"
+                )
+                failed[task["id"]] = error
+            else:
+                delay = min(WG_TASK_MAX_BACKOFF, WG_TASK_RETRY_SECONDS * 2 ** (attempts - 1))
+                logger.warning(
+                    f"Задача {task['id']} ({task['action']} {task['config_id']}): "
+                    f"ошибка, повтор через {delay} с: {error}"
+                )
+                retry[task["id"]] = (error, now + timedelta(seconds=delay))
+
+        await record_wg_task_results(session, done_ids, retry, failed)
+        await session.commit()
+        return len(tasks)
+
+
+async def run_wg_tasks():
+    """
+    Фоновая задача (на реплике-лидере) — выполняет задачи wg_tasks, которые
+    админка ставит вместе с изменением пользователей (одиночными и массовыми
+    действиями). Новые задачи будят обработчик через LISTEN/NOTIFY, а если
+    подписка недоступна — очередь опрашивается раз в WG_TASK_POLL_SECONDS.
+    Прогресс массовых действий виден в админке по статусам задач.
+    """
+    wakeup = asyncio.Event()
+    conn = None
+    try:
+        conn = await listen(WG_TASK_CHANNEL, lambda _payload: wakeup.set())
+    except Exception as e:
+        logger.warning(f"Подписка на {WG_TASK_CHANNEL} недоступна, только опрос очереди: {e}")
+
+    try:
+        while True:
+            try:
+                claimed = await process_wg_tasks_batch()
+            except Exception as e:
+                logger.error(f"Ошибка при выполнении задач wg_tasks: {e}")
+                claimed = 0
+
+            if claimed < WG_TASK_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=WG_TASK_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+    finally:
+        if conn is not None and not conn.is_closed():
+            await conn.close()
@@ -6,9 +6,18 @@ import logging
 from aiogram import Bot, Dispatcher
 from aiogram.types import PreCheckoutQuery, Message, ContentType
 
-from config import BOT_TOKEN
-from core.database import init_db, shutdown_db
-from handlers.auto_disable import schedule_disable_configs
+from config import BOT_TOKEN, BOT_MODE, LEADER_LOCK_KEY, LEADER_RETRY_SECONDS
+from core.database import init_db, shutdown_db, run_user_cache_listener
+from core.leader import LeaderElection
+from core.servers import close_all as close_server_sessions
+from core.warm_pool import run_warm_pool
+from handlers.auto_disable import schedule_disable_configs, schedule_expiry_notices
+from handlers.reminders import schedule_expiry_reminders
+from handlers.reconcile import schedule_reconcile
+from handlers.provision_jobs import run_provisioning_workers
+from handlers.wg_tasks import run_wg_tasks
+from middlewares.database import DbSessionMiddleware
+from middlewares.throttling import ThrottlingMiddleware
 
 # Routers
 from handlers.start import router as start_router
@@ -27,20 +36,49 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-async def on_startup(bot: Bot, dp: Dispatcher):
-    await init_db()
-    asyncio.create_task(schedule_disable_configs(bot))
+async def on_startup(bot: Bot, dp: Dispatcher, run_jobs: bool = True, init_schema: bool = True):
+    """
+    :param run_jobs: Участвовать ли в выборе лидера для фоновых задач
+                     (в режиме webhook — только один процесс на реплику).
+    :param init_schema: Создавать ли таблицы/индексы (в режиме webhook это делает главный процесс).
+    """
+    if init_schema:
+        await init_db()
+    # Сброс кэша пользователей по изменениям из админки и других процессов
+    asyncio.create_task(run_user_cache_listener())
+    # Очередь выдачи конфигов разбирают все процессы всех реплик
+    asyncio.create_task(run_provisioning_workers(bot))
+    if run_jobs:
+        # Фоновые задачи выполняет только реплика-лидер
+        leader = LeaderElection(
+            key=LEADER_LOCK_KEY,
+            jobs=lambda: [
+                schedule_disable_configs(bot),
+                schedule_expiry_notices(bot),
+                schedule_expiry_reminders(bot),
+                run_warm_pool(),
+                schedule_reconcile(),
+                run_wg_tasks(),
+            ],
+            retry_interval=LEADER_RETRY_SECONDS,
+        )
+        asyncio.create_task(leader.run())
 
 
 async def on_shutdown(bot: Bot, dp: Dispatcher):
     await shutdown_db()
+    await close_server_sessions()
     await bot.session.close()
 
 
-async def main():
-    bot = Bot(token=BOT_TOKEN)
+def create_dispatcher() -> Dispatcher:
     dp = Dispatcher()
 
+    # Двойные нажатия и флуд кнопками отсекаются до обращения к БД
+    dp.update.outer_middleware(ThrottlingMiddleware())
+    # Одна сессия БД и одна загрузка пользователя на каждый апдейт
+    dp.update.outer_middleware(DbSessionMiddleware())
+
     # Подключаем все роутеры из handlers/
     dp.include_router(start_router)
     dp.include_router(get_config_router)
@@ -55,12 +93,27 @@ async def main():
 
     # Глобальная обработка pre_checkout_query (если не сработает в payment_router)
 
+    return dp
+
+
+async def main():
+    bot = Bot(token=BOT_TOKEN)
+    dp = create_dispatcher()
+
     await on_startup(bot, dp)
     try:
+        # Если раньше бот работал в режиме webhook, Telegram отвечает на
+        # getUpdates 409 Conflict, пока webhook не удалён
+        await bot.delete_webhook(drop_pending_updates=False)
         await dp.start_polling(bot)
     finally:
         await on_shutdown(bot, dp)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        # Несколько процессов-обработчиков за одним портом (см. webhook.py)
+        from webhook import run_webhook
+        run_webhook()
+    else:
+        asyncio.run(main())
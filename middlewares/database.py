@@ -0,0 +1,32 @@
+# middlewares/database.py
+
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from core.database import AsyncSessionLocal, get_user
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Единица работы на апдейт: одна сессия (и транзакция) БД и однократная
+    загрузка строки пользователя. Хэндлеры получают их в аргументах
+    session и user (dict из get_user или None) и передают session в функции
+    core/database.py. Commit — после успешной обработки, при исключении — rollback.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with AsyncSessionLocal() as session:
+            from_user = data.get("event_from_user")
+            data["session"] = session
+            data["user"] = await get_user(from_user.id, session=session) if from_user else None
+
+            result = await handler(event, data)
+            await session.commit()
+            return result
@@ -0,0 +1,70 @@
+# middlewares/throttling.py
+
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject, Update
+
+from config import THROTTLE_RATE, THROTTLE_BURST
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Защита от двойных нажатий и флуда кнопками (только callback_query):
+    • single-flight — пока обрабатывается нажатие (пользователь, callback.data),
+      такие же нажатия этого пользователя отбрасываются, а не выполняются
+      параллельно (например, два пробных конфига по двойному нажатию);
+    • ведро токенов на пользователя — THROTTLE_RATE нажатий в секунду,
+      не больше THROTTLE_BURST подряд; лишние отбрасываются.
+    Регистрируется до DbSessionMiddleware, поэтому отброшенные нажатия
+    не занимают соединений с БД.
+    """
+
+    def __init__(self, rate: float = THROTTLE_RATE, burst: float = THROTTLE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._in_flight: Set[Tuple[int, str]] = set()
+        # user_id → (токенов, время последнего пополнения)
+        self._buckets: Dict[int, Tuple[float, float]] = {}
+
+    def _take_token(self, user_id: int) -> bool:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self._buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+
+        if len(self._buckets) > 10000:
+            # Полные вёдра хранить незачем — они равны новым
+            full_after = self.burst / self.rate
+            self._buckets = {
+                uid: (t, u) for uid, (t, u) in self._buckets.items() if now - u < full_after
+            }
+        return allowed
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        callback: Optional[CallbackQuery] = event.callback_query if isinstance(event, Update) else None
+        if callback is None:
+            return await handler(event, data)
+
+        user_id = callback.from_user.id
+        if not self._take_token(user_id):
+            await callback.answer("⏳ Слишком часто. Подождите пару секунд.")
+            return None
+
+        key = (user_id, callback.data or "")
+        if key in self._in_flight:
+            await callback.answer("⏳ Уже выполняется…")
+            return None
+
+        self._in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(key)
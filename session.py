@@ -1,40 +1,268 @@
-import requests
+# session.py
+
+import asyncio
 import json
+import logging
+import random
+import time
+from typing import Any, Optional
+
+import aiohttp
+
+from config import (
+    WG_API_URL,
+    WG_API_PASSWORD,
+    WG_API_TIMEOUT,
+    WG_API_CONNECT_TIMEOUT,
+    WG_API_RETRIES,
+    WG_API_RETRY_BASE_SECONDS,
+    WG_API_RETRY_BUDGET,
+    WG_API_BREAKER_THRESHOLD,
+    WG_API_BREAKER_RESET_SECONDS,
+    WG_API_MAX_CONCURRENCY,
+    WG_API_QUEUE_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Методы, которые можно безопасно повторить
+_IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+
+
+class BackendUnavailable(Exception):
+    """
+    Сервер WireGuard сейчас недоступен: выключатель разомкнут, очередь
+    запросов переполнена или запрос не удался после всех повторов.
+    Пользователю стоит предложить повторить попытку позже.
+    """
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель: после threshold ошибок подряд размыкается и
+    reset_timeout секунд отклоняет запросы сразу, не дожидаясь таймаутов.
+    Затем пропускает один пробный запрос: успех замыкает выключатель,
+    ошибка — снова размыкает.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        if time.monotonic() - self._opened_at < self.reset_timeout or self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def release_probe(self) -> None:
+        self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probe_in_flight = False
+        if self._opened_at is not None or self._failures >= self.threshold:
+            if self._opened_at is None:
+                logger.warning(f"API WireGuard: {self._failures} ошибок подряд, выключатель разомкнут")
+            self._opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """
+    Повторы не чаще ratio от числа запросов: каждый запрос пополняет бюджет
+    на ratio, каждый повтор тратит единицу. Когда сервер лежит, повторы не
+    умножают нагрузку на него.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float = 10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+
+    def deposit(self) -> None:
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class APIResponse:
+    """
+    Полностью прочитанный ответ API WireGuard.
+    Повторяет интерфейс requests.Response, которым пользуются обработчики:
+    status_code, content, text и json().
+    """
+
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.content)
 
 
 class APISession:
-    def __init__(self, base_url, password):
-        self.base_url = base_url
+    def __init__(
+        self,
+        base_url: str,
+        password: str,
+        timeout: float = WG_API_TIMEOUT,
+        pool_size: int = WG_API_MAX_CONCURRENCY,
+    ):
+        """
+        Асинхронная сессия к API wg-easy.
+        :param base_url: URL API сервера (например, http://host:51821/api).
+        :param password: Пароль для авторизации.
+        :param timeout: Таймаут одного запроса по умолчанию (в секундах).
+        :param pool_size: Размер пула keep-alive соединений.
+        """
+        self.base_url = base_url.rstrip("/")
         self.password = password
-        self.session = requests.Session()
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._breaker = CircuitBreaker(WG_API_BREAKER_THRESHOLD, WG_API_BREAKER_RESET_SECONDS)
+        self._retry_budget = RetryBudget(WG_API_RETRY_BUDGET)
+        # Ограничение одновременных запросов к этому серверу
+        self._bulkhead = asyncio.Semaphore(WG_API_MAX_CONCURRENCY)
+        self._login_lock = asyncio.Lock()
+        # Увеличивается после каждого успешного логина: по нему запросы,
+        # получившие 401, понимают, что сессию уже обновил кто-то другой
+        self._auth_generation = 0
 
-    def login(self):
-        url = f"{self.base_url}/session"
-        payload = json.dumps({"password": self.password})
-        headers = {"Content-Type": "application/json"}
-        response = self.session.post(url, headers=headers, data=payload)
+    def _get_session(self) -> aiohttp.ClientSession:
+        # ClientSession создаём лениво — уже внутри работающего event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=30),
+                # unsafe=True — иначе aiohttp не сохранит cookie от хоста, заданного IP-адресом
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                timeout=aiohttp.ClientTimeout(total=self.timeout, sock_connect=WG_API_CONNECT_TIMEOUT),
+            )
+        return self._session
 
-        # Вывод для отладки
-        print("URL:", url)
-        print("Headers:", headers)
-        print("Payload:", payload)
-        print("Response Status Code:", response.status_code)
-        print("Response Text:", response.text)
+    async def login(self, generation: Optional[int] = None) -> None:
+        """
+        Выполняет логин на сервере.
+        Одновременные вызовы после 401 сводятся к одному запросу /session:
+        если за время ожидания блокировки логин уже выполнил другой запрос,
+        повторно не логинимся.
+        """
+        async with self._login_lock:
+            if generation is not None and generation != self._auth_generation:
+                return
 
-        if response.status_code != 204:
-            raise Exception(f"Failed to log in: {response.text}")
+            url = f"{self.base_url}/session"
+            session = self._get_session()
+            async with session.post(url, json={"password": self.password}) as response:
+                text = await response.text()
+                if response.status not in (200, 201, 204):
+                    raise Exception(f"Failed to log in: {text}")
 
-    def request(self, method, endpoint, **kwargs):
-        url = f"{self.base_url}/{endpoint}"
-        response = self.session.request(method, url, **kwargs)
+            self._auth_generation += 1
+            logger.info("Авторизация в API WireGuard выполнена")
+
+    async def _send(self, method: str, url: str, timeout: Optional[float], **kwargs) -> APIResponse:
+        session = self._get_session()
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout, sock_connect=WG_API_CONNECT_TIMEOUT)
+        async with session.request(method, url, **kwargs) as response:
+            return APIResponse(response.status, await response.read())
+
+    async def _attempt(self, method: str, url: str, timeout: Optional[float], **kwargs) -> APIResponse:
+        generation = self._auth_generation
+        response = await self._send(method, url, timeout, **kwargs)
 
-        # Если сессия истекла, логинимся и повторяем запрос
+        # Если сессия истекла, логинимся (один раз на всех) и повторяем запрос
         if response.status_code == 401:  # Unauthorized
-            self.login()
-            response = self.session.request(method, url, **kwargs)
+            await self.login(generation)
+            response = await self._send(method, url, timeout, **kwargs)
 
         return response
 
+    async def request(
+        self,
+        method: str,
+        endpoint: str,
+        timeout: Optional[float] = None,
+        idempotent: Optional[bool] = None,
+        **kwargs,
+    ) -> APIResponse:
+        """
+        Выполняет запрос к серверу.
+        :param method: HTTP-метод (GET, POST, PUT, DELETE).
+        :param endpoint: Конечная точка API (например, wireguard/client/).
+        :param timeout: Таймаут именно этого запроса (по умолчанию — self.timeout).
+        :param idempotent: Можно ли повторять запрос при сбое (по умолчанию — по методу).
+        :param kwargs: Дополнительные параметры для запроса (json, data и т.д.).
+        :return: Полностью прочитанный ответ сервера (APIResponse).
+        :raises BackendUnavailable: сервер недоступен — повторять сразу бессмысленно.
+        """
+        url = f"{self.base_url}/{endpoint}"
+        if idempotent is None:
+            idempotent = method.upper() in _IDEMPOTENT_METHODS
+        retries = WG_API_RETRIES if idempotent else 0
+
+        try:
+            await asyncio.wait_for(self._bulkhead.acquire(), timeout=WG_API_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise BackendUnavailable(f"{self.base_url}: слишком много одновременных запросов")
+
+        try:
+            if not self._breaker.allow():
+                raise BackendUnavailable(f"{self.base_url}: выключатель разомкнут")
+            self._retry_budget.deposit()
+            attempt = 0
+            while True:
+                try:
+                    response = await self._attempt(method, url, timeout, **kwargs)
+                    error = None if response.status_code < 500 else f"HTTP {response.status_code}"
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    response, error = None, f"{type(e).__name__}: {e}"
+                except BaseException:
+                    # Прочие ошибки (в том числе отмена) — исход неизвестен,
+                    # но пробный запрос выключателя больше не выполняется
+                    self._breaker.release_probe()
+                    raise
+
+                if error is None:
+                    self._breaker.record_success()
+                    return response
+
+                self._breaker.record_failure()
+                if attempt >= retries or not self._breaker.allow() or not self._retry_budget.withdraw():
+                    if response is not None:
+                        # 5xx отдаём вызывающему коду — он сообщит об ошибке API
+                        return response
+                    raise BackendUnavailable(f"{self.base_url}: {error}")
+
+                attempt += 1
+                # Экспоненциальная пауза со случайным разбросом («full jitter»)
+                await asyncio.sleep(random.uniform(0, WG_API_RETRY_BASE_SECONDS * 2 ** attempt))
+        finally:
+            self._bulkhead.release()
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
 
 # Экземпляр для использования
-api_session = APISession(base_url="http://109.71.246.92:51821/api", password="1234")
+api_session = APISession(base_url=WG_API_URL, password=WG_API_PASSWORD)
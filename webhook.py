@@ -0,0 +1,154 @@
+# webhook.py
+
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing as mp
+from typing import List
+
+from aiogram import Bot
+from aiohttp import web
+
+from config import (
+    BOT_TOKEN,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_WORKERS,
+)
+
+logger = logging.getLogger(__name__)
+
+# spawn, а не fork: процессам-обработчикам не нужно наследовать состояние главного
+_ctx = mp.get_context("spawn")
+
+
+def _update_user_id(update: dict) -> int:
+    """
+    Id пользователя (или чата), от которого пришёл апдейт.
+    По нему все апдейты одного пользователя попадают в один и тот же процесс.
+    """
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        chat = value.get("chat")
+        if chat:
+            return chat["id"]
+    return update.get("update_id", 0)
+
+
+async def _run_worker(index: int, queue) -> None:
+    # Импорт здесь: процесс запущен через spawn и собирает бота заново
+    from main import create_dispatcher, on_startup, on_shutdown
+
+    bot = Bot(token=BOT_TOKEN)
+    dp = create_dispatcher()
+    # Фоновые задачи — только в одном процессе
+    await on_startup(bot, dp, run_jobs=index == 0, init_schema=False)
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is None:
+                break
+            task = asyncio.create_task(dp.feed_raw_update(bot, json.loads(raw)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await on_shutdown(bot, dp)
+
+
+def _worker_main(index: int, queue) -> None:
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_run_worker(index, queue))
+
+
+def _start_worker(index: int, queue):
+    process = _ctx.Process(target=_worker_main, args=(index, queue), name=f"bot-worker-{index}")
+    process.start()
+    return process
+
+
+async def _handle_update(request: web.Request) -> web.Response:
+    # Без проверки секрета любой, кто достучится до порта, мог бы прислать
+    # поддельный апдейт (например, successful_payment)
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        return web.Response(status=401)
+
+    raw = await request.read()
+    try:
+        update = json.loads(raw)
+    except ValueError:
+        return web.Response(status=400)
+
+    queues: List = request.app["queues"]
+    queues[_update_user_id(update) % len(queues)].put(raw)
+    return web.Response()
+
+
+async def _supervise(app: web.Application) -> None:
+    # Перезапускаем упавшие процессы-обработчики; их очереди с апдейтами сохраняются
+    while True:
+        await asyncio.sleep(5)
+        for index, process in enumerate(app["workers"]):
+            if not process.is_alive():
+                logger.error(f"Обработчик {index} завершился (код {process.exitcode}), перезапускаем")
+                app["workers"][index] = _start_worker(index, app["queues"][index])
+
+
+async def _on_startup(app: web.Application) -> None:
+    from core.database import init_db, shutdown_db
+
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook, но WEBHOOK_URL не задан")
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook, но WEBHOOK_SECRET не задан")
+
+    # Схему БД готовим один раз, до запуска обработчиков
+    await init_db()
+    await shutdown_db()
+
+    app["queues"] = [_ctx.Queue() for _ in range(WEBHOOK_WORKERS)]
+    app["workers"] = [_start_worker(i, q) for i, q in enumerate(app["queues"])]
+    app["supervisor"] = asyncio.create_task(_supervise(app))
+
+    bot = Bot(token=BOT_TOKEN)
+    try:
+        await bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    finally:
+        await bot.session.close()
+
+
+async def _on_cleanup(app: web.Application) -> None:
+    app["supervisor"].cancel()
+    for queue in app["queues"]:
+        queue.put(None)
+    for process in app["workers"]:
+        await asyncio.get_running_loop().run_in_executor(None, process.join, 30)
+
+
+def run_webhook() -> None:
+    """
+    Режим webhook: главный процесс принимает апдейты на WEBHOOK_PORT и
+    раскладывает их по WEBHOOK_WORKERS процессам-обработчикам по id
+    пользователя, так что апдейты одного пользователя всегда обрабатывает
+    один и тот же процесс.
+    """
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, _handle_update)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT)